@@ -0,0 +1,196 @@
+// Compact binary encoding of annotation events ("bin2"), shared by the server
+// and the annotation pages (loaded there as /annotationCodec.js).
+//
+// A packet is a type byte followed by zigzag varints:
+//   Rect       initX initY width height
+//   Highlight  initX initY (finalX - initX)
+//   Text       initX initY content (count, then one UTF-16 code unit each)
+// Coordinates are sent in tenths of a pixel. The author and session strings
+// are replaced by indices into a table that the encoder grows and announces
+// separately ('Wire' messages), so a packet can be built once and sent to
+// every member of a session. Events the format cannot express exactly
+// (other fields, finer coordinates, other content) are sent as JSON behind
+// the RAW type byte, so every member decodes the object the sender sent.
+(function(exports) {
+
+  var TYPES = ['Rect', 'Highlight', 'Text'];
+  var EVENTS = {'Rect' : 'Rectangle', 'Highlight' : 'Highlight', 'Text' : 'Text'};
+  var RAW = 255;
+  var HAS_ID = 1, HAS_MEASURE = 2;
+  var SCALE = 10;
+  var FIELDS = {
+    'Rect' : ['type', 'initX', 'initY', 'author', 'session', 'id', 'measure', 'width', 'height'],
+    'Highlight' : ['type', 'initX', 'initY', 'author', 'session', 'id', 'measure', 'finalX'],
+    'Text' : ['type', 'initX', 'initY', 'author', 'session', 'id', 'measure', 'content']
+  };
+
+  function utf8Encode(str) {
+    var s = unescape(encodeURIComponent(str)), bytes = [];
+    for (var i = 0; i < s.length; i++) bytes.push(s.charCodeAt(i));
+    return bytes;
+  }
+
+  function utf8Decode(bytes, start, end) {
+    var s = '';
+    for (var i = start; i < end; i++) s += String.fromCharCode(bytes[i]);
+    return decodeURIComponent(escape(s));
+  }
+
+  function writeUint(out, n) {
+    while (n >= 128) {
+      out.push((n % 128) | 128);
+      n = Math.floor(n / 128);
+    }
+    out.push(n);
+  }
+
+  function writeInt(out, n) {
+    writeUint(out, n < 0 ? -2 * n - 1 : 2 * n);
+  }
+
+  function writeString(out, str) {
+    var bytes = utf8Encode(str);
+    writeUint(out, bytes.length);
+    for (var i = 0; i < bytes.length; i++) out.push(bytes[i]);
+  }
+
+  function isCoord(v) {
+    return typeof v == 'number' && isFinite(v) && Math.abs(v) < 1e8 && Math.round(v * SCALE) / SCALE === v;
+  }
+
+  function onlyFields(obj, fields) {
+    for (var key in obj) {
+      if (fields.indexOf(key) == -1) return false;
+    }
+    return true;
+  }
+
+  // the content of a Text: an array of single characters (UTF-16 code units)
+  function isContent(v) {
+    if (!Array.isArray(v)) return false;
+    for (var i = 0; i < v.length; i++) {
+      if (typeof v[i] != 'string' || v[i].length != 1) return false;
+    }
+    return true;
+  }
+
+  function coord(v) {
+    return Math.round(v * SCALE);
+  }
+
+  // Encoder: one per session, owns the string table.
+  var Encoder = function() {
+    this.table = [];
+    this.index = {};      // string -> table index
+  };
+
+  Encoder.prototype.intern = function(str, added) {
+    var key = 's' + str;
+    if (this.index[key] == null) {
+      this.index[key] = this.table.length;
+      this.table.push(str);
+      added.push(str);
+    }
+    return this.index[key];
+  };
+
+  // -> {bytes: Uint8Array, added: [strings appended to the table]}
+  Encoder.prototype.encode = function(obj) {
+    var out = [], added = [];
+    var type = TYPES.indexOf(obj.type);
+    var fits = type != -1 && onlyFields(obj, FIELDS[obj.type]) && isCoord(obj.initX) && isCoord(obj.initY) &&
+               typeof obj.author == 'string' && typeof obj.session == 'string' &&
+               (!('id' in obj) || typeof obj.id == 'string') &&
+               (!('measure' in obj) || (typeof obj.measure == 'number' && obj.measure >= 0 && obj.measure % 1 == 0));
+    if (fits && obj.type == 'Rect') fits = isCoord(obj.width) && isCoord(obj.height);
+    if (fits && obj.type == 'Highlight') fits = isCoord(obj.finalX);
+    if (fits && obj.type == 'Text') fits = isContent(obj.content);
+    if (!fits) {
+      out.push(RAW);
+      var raw = utf8Encode(JSON.stringify(obj));
+      for (var i = 0; i < raw.length; i++) out.push(raw[i]);
+      return {bytes: new Uint8Array(out), added: added};
+    }
+    out.push(type);
+    out.push(('id' in obj ? HAS_ID : 0) | ('measure' in obj ? HAS_MEASURE : 0));
+    writeUint(out, this.intern(obj.author, added));
+    writeUint(out, this.intern(obj.session, added));
+    var x = coord(obj.initX), y = coord(obj.initY);
+    writeInt(out, x);
+    writeInt(out, y);
+    if (obj.type == 'Rect') {
+      writeInt(out, coord(obj.width));
+      writeInt(out, coord(obj.height));
+    } else if (obj.type == 'Highlight') {
+      writeInt(out, coord(obj.finalX) - x);
+    } else {
+      writeUint(out, obj.content.length);
+      for (var i = 0; i < obj.content.length; i++) writeUint(out, obj.content[i].charCodeAt(0));
+    }
+    if ('id' in obj) writeString(out, obj.id);
+    if ('measure' in obj) writeUint(out, obj.measure);
+    return {bytes: new Uint8Array(out), added: added};
+  };
+
+  // Decoder: one per client, mirrors the session's string table.
+  var Decoder = function() {
+    this.table = [];
+  };
+
+  // apply a 'Wire' table update: {offset, table}
+  Decoder.prototype.update = function(msg) {
+    for (var i = 0; i < msg.table.length; i++) this.table[msg.offset + i] = msg.table[i];
+  };
+
+  // -> {event, value} where event is the name the JSON format would use
+  Decoder.prototype.decode = function(data) {
+    var bytes = new Uint8Array(data), pos = 0, table = this.table;
+    function readUint() {
+      var n = 0, mul = 1, b;
+      do {
+        b = bytes[pos++];
+        n += (b & 127) * mul;
+        mul *= 128;
+      } while (b & 128);
+      return n;
+    }
+    function readInt() {
+      var n = readUint();
+      return n % 2 ? -(n + 1) / 2 : n / 2;
+    }
+    function readString() {
+      var len = readUint(), str = utf8Decode(bytes, pos, pos + len);
+      pos += len;
+      return str;
+    }
+    var type = bytes[pos++];
+    if (type == RAW) {
+      var obj = JSON.parse(utf8Decode(bytes, 1, bytes.length));
+      return {event: EVENTS[obj.type] || obj.type, value: obj};
+    }
+    var flags = bytes[pos++];
+    var obj = {"type" : TYPES[type]};
+    obj.author = table[readUint()];
+    obj.session = table[readUint()];
+    var x = readInt(), y = readInt();
+    obj.initX = x / SCALE;
+    obj.initY = y / SCALE;
+    if (obj.type == 'Rect') {
+      obj.width = readInt() / SCALE;
+      obj.height = readInt() / SCALE;
+    } else if (obj.type == 'Highlight') {
+      obj.finalX = (x + readInt()) / SCALE;
+    } else {
+      obj.content = [];
+      for (var n = readUint(); n > 0; n--) obj.content.push(String.fromCharCode(readUint()));
+    }
+    if (flags & HAS_ID) obj.id = readString();
+    if (flags & HAS_MEASURE) obj.measure = readUint();
+    return {event: EVENTS[obj.type], value: obj};
+  };
+
+  exports.FORMAT = 'bin2';
+  exports.Encoder = Encoder;
+  exports.Decoder = Decoder;
+
+})(typeof exports == 'undefined' ? (this.AnnotationCodec = {}) : exports);
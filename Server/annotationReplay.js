@@ -0,0 +1,160 @@
+var zlib = require('zlib');
+
+// Keeps a compacted copy of every annotation log so late joiners get one
+// snapshot message plus the short tail of events that came after it, instead
+// of a findAll and one emit per stored document.
+var AnnotationReplay = function(collectionDriver, options) {
+  options = options || {};
+  this.collectionDriver = collectionDriver;
+  this.compactAfter = options.compactAfter || 200;        // tail length that forces a compaction
+  this.compactInterval = options.compactInterval || 30000; // ms between periodic compactions
+  this.logs = {};       // collection name -> log
+  this.idPrefix = options.idPrefix || '';                  // keeps ids from several processes apart
+  this.nextId = 0;
+  var self = this;
+  this.timer = setInterval(function() { self.compactAll(); }, this.compactInterval);
+  if (this.timer.unref) this.timer.unref();
+};
+
+// key an annotation is folded on: the client id, or the Mongo id for old documents
+function annotationKey(obj) {
+  if (obj.id != null) return 'a' + obj.id;
+  return 'a' + obj._id;
+}
+
+AnnotationReplay.prototype.getLog = function(collectionName) {
+  var log = this.logs[collectionName];
+  if (!log) {
+    log = this.logs[collectionName] = {
+      items: {},        // annotation key -> live annotation, in insertion order
+      tail: [],         // events recorded after the last snapshot
+      snapshot: null,   // {count, items, measures, deflated}
+      tombstones: 0,    // deletions in the tail, still part of the snapshot
+      loaded: false,
+      waiting: null     // callbacks queued while the log is read from Mongo
+    };
+  }
+  return log;
+};
+
+AnnotationReplay.prototype.apply = function(log, obj) {
+  var key = annotationKey(obj);
+  delete log.items[key];            // an overwrite moves the annotation to the end
+  if (!obj.deleted) log.items[key] = obj;
+};
+
+// record a new annotation event; gives it an id if the client did not
+AnnotationReplay.prototype.record = function(collectionName, obj) {
+  if (obj.id == null) obj.id = this.idPrefix + Date.now().toString(36) + '.' + (this.nextId++).toString(36);
+  var log = this.getLog(collectionName);
+  if (!log.loaded) {                // folded in once the stored log has been read
+    log.tail.push(obj);
+    if (log.tail.length >= this.compactAfter) this.load(collectionName, function() {});
+    return;
+  }
+  this.apply(log, obj);
+  log.tail.push(obj);
+  // a deletion stays in the tail as a tombstone until the next compaction
+  if (obj.deleted) log.tombstones++;
+  if (log.tail.length >= this.compactAfter) this.compact(collectionName);
+};
+
+// read the stored log once per collection; concurrent callers share the read
+AnnotationReplay.prototype.load = function(collectionName, callback) {
+  var log = this.getLog(collectionName);
+  if (log.loaded) return callback(null, log);
+  if (log.waiting) return log.waiting.push(callback);
+  log.waiting = [callback];
+  var self = this;
+  this.collectionDriver.findAll(collectionName, function(error, results) {
+    var waiting = log.waiting;
+    log.waiting = null;
+    if (error) {
+      for (var i = 0; i < waiting.length; i++) waiting[i](error);
+      return;
+    }
+    var early = log.tail;           // events recorded while we were reading
+    for (var i = 0; i < results.length; i++) self.apply(log, results[i]);
+    for (var i = 0; i < early.length; i++) self.apply(log, early[i]);
+    log.loaded = true;
+    self.compact(collectionName);
+    for (var i = 0; i < waiting.length; i++) waiting[i](null, log);
+  });
+};
+
+// fold the tail into a new snapshot, indexed by measure where the client sent one
+AnnotationReplay.prototype.compact = function(collectionName) {
+  var log = this.logs[collectionName];
+  if (!log || !log.loaded) return;
+  if (log.snapshot && log.tail.length == 0) return;
+  var items = [], measures = {};
+  for (var key in log.items) {
+    var obj = log.items[key];
+    if (typeof obj.measure == 'number') {
+      if (!measures[obj.measure]) measures[obj.measure] = [];
+      measures[obj.measure].push(items.length);
+    }
+    items.push(obj);
+  }
+  log.snapshot = {count: items.length, items: items, measures: measures, deflated: null};
+  log.tail = [];
+  log.tombstones = 0;
+};
+
+AnnotationReplay.prototype.compactAll = function() {
+  for (var collectionName in this.logs) this.compact(collectionName);
+};
+
+// forget the log of a collection nobody here follows any more; it is read
+// from the database again when the next member joins
+AnnotationReplay.prototype.drop = function(collectionName) {
+  var log = this.logs[collectionName];
+  if (log && !log.waiting) delete this.logs[collectionName];
+};
+
+// deflate the snapshot once and share the buffer with every late joiner
+AnnotationReplay.prototype.deflate = function(snapshot, callback) {
+  if (snapshot.deflated) return callback(null, snapshot.deflated);
+  var json = JSON.stringify({items: snapshot.items, measures: snapshot.measures});
+  zlib.deflate(json, function(error, buffer) {
+    if (error) return callback(error);
+    snapshot.deflated = buffer;
+    callback(null, buffer);
+  });
+};
+
+// Send the annotations of a collection to one socket. Clients that ask for a
+// snapshot get it as one 'Annotation Snapshot' message, deflated if they can
+// inflate it; older clients get the compacted annotations one by one. Both
+// are followed by the tail and the usual null terminator.
+AnnotationReplay.prototype.replay = function(collectionName, socket, options, callback) {
+  options = options || {};
+  var self = this;
+  this.load(collectionName, function(error, log) {
+    if (error) return callback(error);
+    if (log.tombstones) self.compact(collectionName);   // never replay deleted annotations
+    var snapshot = log.snapshot, tail = log.tail.slice();
+    function sendTail() {
+      for (var i = 0; i < tail.length; i++) socket.emit('Annotation', tail[i]);
+      socket.emit('Annotation', null);
+      callback(null, snapshot.count + tail.length);
+    }
+    if (!options.snapshot) {
+      for (var i = 0; i < snapshot.items.length; i++) socket.emit('Annotation', snapshot.items[i]);
+      return sendTail();
+    }
+    if (!options.compress) {
+      socket.emit('Annotation Snapshot', {"type" : "Snapshot", "count" : snapshot.count, "encoding" : "json",
+                                          "value" : {items: snapshot.items, measures: snapshot.measures}});
+      return sendTail();
+    }
+    self.deflate(snapshot, function(error, buffer) {
+      if (error) return callback(error);
+      socket.emit('Annotation Snapshot', {"type" : "Snapshot", "count" : snapshot.count, "encoding" : "deflate",
+                                          "value" : buffer});
+      sendTail();
+    });
+  });
+};
+
+exports.AnnotationReplay = AnnotationReplay;
@@ -0,0 +1,80 @@
+// Write-behind buffer for annotation saves. Events are queued per collection,
+// repeated saves of the same annotation replace each other in the queue, and
+// each queue is written with a single insert once it holds maxBatch events or
+// its oldest event is flushInterval ms old.
+var AnnotationStore = function(collectionDriver, options) {
+  options = options || {};
+  this.collectionDriver = collectionDriver;
+  this.maxBatch = options.maxBatch || 100;
+  this.flushInterval = options.flushInterval || 250;   // longest time an event stays unwritten
+  this.buffers = {};    // collection name -> {docs, callbacks, index, timer}
+  this.writing = 0;     // inserts sent to the database and not answered yet
+  this.idle = [];       // callbacks waiting for the writes to finish
+};
+
+AnnotationStore.prototype.getBuffer = function(collectionName) {
+  var buffer = this.buffers[collectionName];
+  if (!buffer) {
+    buffer = this.buffers[collectionName] = {docs: [], callbacks: [], index: {}, timer: null};
+  }
+  return buffer;
+};
+
+AnnotationStore.prototype.save = function(collectionName, obj, callback) {
+  var buffer = this.getBuffer(collectionName);
+  var key = obj.id != null ? 'a' + obj.id : null;
+  if (key && buffer.index[key] != null) {
+    buffer.docs[buffer.index[key]] = obj;     // coalesce with the queued version
+  } else {
+    if (key) buffer.index[key] = buffer.docs.length;
+    buffer.docs.push(obj);
+  }
+  if (callback) buffer.callbacks.push(callback);
+
+  if (buffer.docs.length >= this.maxBatch) {
+    this.flush(collectionName);
+  } else if (!buffer.timer) {
+    var self = this;
+    buffer.timer = setTimeout(function() { self.flush(collectionName); }, this.flushInterval);
+  }
+};
+
+AnnotationStore.prototype.flush = function(collectionName, callback) {
+  var buffer = this.buffers[collectionName];
+  if (!buffer || buffer.docs.length == 0) {
+    if (callback) callback(null, 0);
+    return;
+  }
+  clearTimeout(buffer.timer);
+  delete this.buffers[collectionName];    // new events start a fresh buffer
+  this.writing++;
+  var self = this;
+  this.collectionDriver.saveAll(collectionName, buffer.docs, function(error, docs) {
+    for (var i = 0; i < buffer.callbacks.length; i++) {
+      if (error) buffer.callbacks[i](error);
+      else buffer.callbacks[i](null, docs);
+    }
+    if (callback) callback(error, buffer.docs.length);
+    if (--self.writing == 0) {
+      var idle = self.idle;
+      self.idle = [];
+      for (var i = 0; i < idle.length; i++) idle[i]();
+    }
+  });
+};
+
+// write out everything that is still queued, e.g. before the process exits;
+// callback(err) once every write, also those flushed earlier, has finished
+AnnotationStore.prototype.flushAll = function(callback) {
+  var names = Object.keys(this.buffers), failed = null;
+  for (var i = 0; i < names.length; i++) {
+    this.flush(names[i], function(error) {
+      if (error) failed = error;
+    });
+  }
+  if (!callback) return;
+  if (this.writing == 0) return callback(null);
+  this.idle.push(function() { callback(failed); });
+};
+
+exports.AnnotationStore = AnnotationStore;
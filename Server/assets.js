@@ -0,0 +1,258 @@
+var fs = require('fs'),
+    path = require('path'),
+    url = require('url'),
+    crypto = require('crypto'),
+    zlib = require('zlib');
+
+// The static files of the pages (scripts, stylesheets, images, fonts and
+// the pages themselves), read into memory once at startup.
+//
+// Files with the same content are stored once and get one content-hashed
+// url under /assets/, which is served with a long-lived cache header.
+// References in the pages and stylesheets are rewritten to these urls, so
+// the copies under file/ and get-file/ are only downloaded once. The
+// original paths keep working and are revalidated with their ETag.
+// Text assets are gzip (and, where node has it, brotli) compressed once.
+var TYPES = {
+  '.html' : 'text/html; charset=UTF-8',
+  '.js'   : 'application/javascript; charset=UTF-8',
+  '.css'  : 'text/css; charset=UTF-8',
+  '.png'  : 'image/png',
+  '.jpg'  : 'image/jpeg',
+  '.gif'  : 'image/gif',
+  '.ico'  : 'image/x-icon',
+  '.svg'  : 'image/svg+xml',
+  '.eot'  : 'application/vnd.ms-fontobject',
+  '.ttf'  : 'application/x-font-ttf',
+  '.woff' : 'application/font-woff'
+};
+var COMPRESS = /^\.(html|js|css|svg|eot|ttf)$/;
+var IMMUTABLE = 'public, max-age=31536000, immutable';
+var REVALIDATE = 'no-cache';
+
+// options: skip (top-level names never served), scripts (the top-level .js
+// files the pages load; the others there are server code and never served)
+var Assets = function(root, options) {
+  options = options || {};
+  this.root = root;
+  this.skip = options.skip || [];
+  this.scripts = options.scripts || [];
+  this.prefix = '/assets/';
+  this.files = {};      // url path -> asset {hash, type, body, gzip, br, url}
+  this.byHash = {};     // content hash -> asset
+  this.hashed = {};     // content-hashed url -> asset
+};
+
+// read all assets; callback() once they are compressed
+Assets.prototype.load = function(callback) {
+  var self = this;
+  var files = this.walk('');
+  // stylesheets refer to images and fonts, pages to all of them: add them in that order
+  function rank(file) {
+    var ext = path.extname(file).toLowerCase();
+    return ext == '.html' ? 2 : ext == '.css' ? 1 : 0;
+  }
+  files.sort(function(a, b) { return rank(a) - rank(b); });
+  files.forEach(function(file) { self.add(file); });
+  this.compress(callback || function() {});
+};
+
+Assets.prototype.walk = function(dir) {
+  var files = [];
+  var self = this;
+  fs.readdirSync(path.join(this.root, dir)).forEach(function(name) {
+    var rel = dir ? dir + '/' + name : name;
+    var full = path.join(self.root, rel);
+    if (name.charAt(0) == '.' || (!dir && self.skip.indexOf(name) != -1)) return;
+    if (fs.statSync(full).isDirectory()) return files.push.apply(files, self.walk(rel));
+    var ext = path.extname(name).toLowerCase();
+    if (!TYPES[ext]) return;
+    if (!dir && ext == '.js' && self.scripts.indexOf(name) == -1) return;   // server code
+    files.push(rel);
+  });
+  return files;
+};
+
+Assets.prototype.add = function(rel) {
+  var ext = path.extname(rel).toLowerCase();
+  var body = fs.readFileSync(path.join(this.root, rel));
+  if (ext == '.css' || ext == '.html') {
+    body = Buffer.from(this.rewrite(body.toString('utf8'), path.posix.dirname('/' + rel), ext == '.css'));
+  }
+  var hash = crypto.createHash('sha1').update(ext).update(body).digest('hex').slice(0, 16);
+  var asset = this.byHash[hash];
+  if (!asset) {
+    var base = path.basename(rel, path.extname(rel));
+    asset = this.byHash[hash] = {
+      hash: hash, type: TYPES[ext], body: body, gzip: null, br: null,
+      compress: COMPRESS.test(ext), url: this.prefix + base + '.' + hash.slice(0, 10) + ext
+    };
+    this.hashed[asset.url] = asset;
+  }
+  this.files['/' + rel] = asset;
+};
+
+// point src/href (pages) or url() (stylesheets) references at the hashed urls
+Assets.prototype.rewrite = function(text, dir, css) {
+  var self = this;
+  function resolve(ref) {
+    if (/^([a-z]+:|\/\/|#)/i.test(ref)) return ref;     // other sites, data: urls, fragments
+    var parts = /^([^?#]*)(.*)$/.exec(ref);
+    if (!parts[1]) return ref;
+    var target = parts[1].charAt(0) == '/' ? parts[1] : path.posix.join(dir, parts[1]);
+    var asset = self.files[target];
+    if (asset && asset.type != TYPES['.html']) return asset.url + parts[2];
+    return css ? target + parts[2] : ref;   // the stylesheet moves to /assets/: keep the reference absolute
+  }
+  if (css) {
+    return text.replace(/url\(\s*(['"]?)([^'")]+)\1\s*\)/g, function(all, quote, ref) {
+      return 'url(' + quote + resolve(ref) + quote + ')';
+    });
+  }
+  return text.replace(/\b(src|href)=(["'])([^"']+)\2/g, function(all, attr, quote, ref) {
+    return attr + '=' + quote + resolve(ref) + quote;
+  });
+};
+
+// one job at a time, so startup does not hold up the threadpool for file access
+Assets.prototype.compress = function(callback) {
+  var jobs = [];
+  for (var hash in this.byHash) {
+    var asset = this.byHash[hash];
+    if (!asset.compress) continue;
+    jobs.push([asset, 'gzip']);
+    if (zlib.brotliCompress) jobs.push([asset, 'br']);
+  }
+  (function next() {
+    var job = jobs.shift();
+    if (!job) return callback();
+    var asset = job[0], encoding = job[1];
+    var compress = encoding == 'br' ? zlib.brotliCompress : zlib.gzip;
+    compress(asset.body, encoding == 'br' ? {} : {level: 9}, function(err, data) {
+      if (!err && data.length < asset.body.length) asset[encoding] = data;
+      next();
+    });
+  })();
+};
+
+// the middleware serving all assets, registered once
+Assets.prototype.middleware = function() {
+  var self = this;
+  return function(req, res, next) {
+    if (req.method != 'GET' && req.method != 'HEAD') return next();
+    try {
+      var pathname = decodeURIComponent(url.parse(req.url).pathname);
+    } catch (e) {
+      return next();
+    }
+    if (self.hashed[pathname]) return self.send(req, res, self.hashed[pathname], IMMUTABLE);
+    if (self.files[pathname]) return self.send(req, res, self.files[pathname], REVALIDATE);
+    next();
+  };
+};
+
+// send a page (path relative to the root), e.g. as the answer to a form post
+Assets.prototype.sendPage = function(req, res, rel) {
+  var asset = this.files['/' + rel];
+  if (!asset) return res.sendFile(path.join(this.root, rel));
+  this.send(req, res, asset, REVALIDATE);
+};
+
+Assets.prototype.send = function(req, res, asset, cacheControl) {
+  var accept = req.headers['accept-encoding'] || '';
+  var encoding = null;
+  if (!req.headers.range) {       // ranges are served from the plain body
+    if (asset.br && /\bbr\b/.test(accept)) encoding = 'br';
+    else if (asset.gzip && /\bgzip\b/.test(accept)) encoding = 'gzip';
+  }
+  var body = encoding ? asset[encoding] : asset.body;
+  var etag = '"' + asset.hash + (encoding ? '-' + encoding : '') + '"';
+  res.setHeader('Content-Type', asset.type);
+  res.setHeader('Cache-Control', cacheControl);
+  if (asset.gzip || asset.br) res.setHeader('Vary', 'Accept-Encoding');
+  if (encoding) res.setHeader('Content-Encoding', encoding);
+  respond(req, res, body.length, etag, null, function(start, end) {
+    res.end(req.method == 'HEAD' ? undefined : body.slice(start, end + 1));
+  });
+};
+
+// Conditional and range handling shared by assets and downloads.
+// write(start, end) sends the selected bytes after the headers are set.
+function respond(req, res, size, etag, lastModified, write) {
+  var cacheable = req.method == 'GET' || req.method == 'HEAD';
+  res.setHeader('ETag', etag);
+  if (lastModified) res.setHeader('Last-Modified', lastModified.toUTCString());
+  res.setHeader('Accept-Ranges', 'bytes');
+  if (cacheable && isFresh(req, etag, lastModified)) {
+    res.statusCode = 304;
+    res.removeHeader('Content-Type');
+    res.removeHeader('Content-Encoding');
+    return res.end();
+  }
+  var range = cacheable ? parseRange(req, size, etag, lastModified) : null;
+  if (range == -1) {
+    res.statusCode = 416;
+    res.setHeader('Content-Range', 'bytes */' + size);
+    return res.end();
+  }
+  if (range) {
+    res.statusCode = 206;
+    res.setHeader('Content-Range', 'bytes ' + range.start + '-' + range.end + '/' + size);
+    res.setHeader('Content-Length', range.end - range.start + 1);
+    return write(range.start, range.end);
+  }
+  res.setHeader('Content-Length', size);
+  write(0, size - 1);
+}
+
+function isFresh(req, etag, lastModified) {
+  var noneMatch = req.headers['if-none-match'];
+  if (noneMatch) {
+    return noneMatch.split(/\s*,\s*/).some(function(tag) {
+      return tag == '*' || tag.replace(/^W\//, '') == etag.replace(/^W\//, '');
+    });
+  }
+  var since = Date.parse(req.headers['if-modified-since']);
+  return !!lastModified && !isNaN(since) && Math.floor(lastModified.getTime() / 1000) * 1000 <= since;
+}
+
+// -> {start, end} for a single satisfiable range, -1 if it cannot be
+// satisfied, null to send everything (no range, stale If-Range, several ranges)
+function parseRange(req, size, etag, lastModified) {
+  var header = req.headers.range;
+  if (!header) return null;
+  var ifRange = req.headers['if-range'];
+  if (ifRange && ifRange != etag && !(lastModified && Date.parse(ifRange) == Math.floor(lastModified.getTime() / 1000) * 1000)) return null;
+  var match = /^bytes=(\d*)-(\d*)$/.exec(header.trim());
+  if (!match || (!match[1] && !match[2])) return null;
+  var start, end;
+  if (!match[1]) {                // suffix: the last n bytes
+    start = Math.max(0, size - Number(match[2]));
+    end = size - 1;
+  } else {
+    start = Number(match[1]);
+    end = match[2] ? Math.min(Number(match[2]), size - 1) : size - 1;
+  }
+  if (start >= size || start > end) return -1;
+  return {start: start, end: end};
+}
+
+// send a file as a download, with ETag/Last-Modified validators and ranges
+function sendFile(req, res, file) {
+  fs.stat(file, function(err, stat) {
+    if (err || !stat.isFile()) {
+      res.statusCode = 404;
+      return res.end();
+    }
+    var etag = 'W/"' + stat.size.toString(16) + '-' + stat.mtime.getTime().toString(16) + '"';
+    res.setHeader('Content-Type', 'application/octet-stream');
+    res.setHeader('Content-Disposition', 'attachment; filename="' + path.basename(file).replace(/"/g, '') + '"');
+    respond(req, res, stat.size, etag, stat.mtime, function(start, end) {
+      if (req.method == 'HEAD' || end < start) return res.end();
+      fs.createReadStream(file, {start: start, end: end}).pipe(res);
+    });
+  });
+}
+
+exports.Assets = Assets;
+exports.sendFile = sendFile;
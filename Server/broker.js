@@ -0,0 +1,202 @@
+// Shared state and publish/subscribe between the processes of a cluster.
+//
+// Every server process talks to the broker through a client with this API:
+//   get(key, callback), set(key, value, callback), remove(key, callback),
+//   keys(prefix, callback), publish(channel, message),
+//   subscribe(channel, handler), unsubscribe(channel, handler)
+// A message reaches the subscribers of every other client, not the one that
+// published it; that client delivers to its own sockets itself. Values and
+// messages must survive JSON.
+//
+// LocalBroker keeps everything in memory. In a single process, or in a test
+// standing in for several workers, its clients come from connect(). In
+// cluster mode the master owns the LocalBroker and every worker reaches it
+// over its IPC channel through an IpcBroker (see serveBroker). Another
+// backend (e.g. a redis server) only has to provide the client API.
+var LocalBroker = function() {
+  this.state = {};
+  this.channels = {};   // channel -> [clients subscribed to it]
+};
+
+function copy(value) {
+  return value === undefined ? null : JSON.parse(JSON.stringify(value));
+}
+
+LocalBroker.prototype.connect = function() {
+  return new LocalClient(this);
+};
+
+LocalBroker.prototype.deliver = function(channel, message, sender) {
+  var clients = this.channels[channel] || [];
+  for (var i = 0; i < clients.length; i++) {
+    if (clients[i] != sender) clients[i].receive(channel, copy(message));
+  }
+};
+
+var LocalClient = function(broker) {
+  this.broker = broker;
+  this.handlers = {};   // channel -> [handler]
+};
+
+LocalClient.prototype.get = function(key, callback) {
+  var value = copy(this.broker.state[key]);
+  process.nextTick(function() { callback(null, value); });
+};
+
+LocalClient.prototype.set = function(key, value, callback) {
+  this.broker.state[key] = copy(value);
+  if (callback) process.nextTick(function() { callback(null); });
+};
+
+LocalClient.prototype.remove = function(key, callback) {
+  delete this.broker.state[key];
+  if (callback) process.nextTick(function() { callback(null); });
+};
+
+LocalClient.prototype.keys = function(prefix, callback) {
+  var keys = Object.keys(this.broker.state).filter(function(key) { return key.indexOf(prefix) == 0; });
+  process.nextTick(function() { callback(null, keys); });
+};
+
+LocalClient.prototype.publish = function(channel, message) {
+  var broker = this.broker, self = this;
+  message = copy(message);
+  process.nextTick(function() { broker.deliver(channel, message, self); });
+};
+
+LocalClient.prototype.subscribe = function(channel, handler) {
+  if (!this.handlers[channel]) {
+    this.handlers[channel] = [];
+    (this.broker.channels[channel] = this.broker.channels[channel] || []).push(this);
+  }
+  this.handlers[channel].push(handler);
+};
+
+LocalClient.prototype.unsubscribe = function(channel, handler) {
+  var handlers = this.handlers[channel];
+  if (!handlers) return;
+  var i = handlers.indexOf(handler);
+  if (i != -1) handlers.splice(i, 1);
+  if (handlers.length) return;
+  delete this.handlers[channel];
+  var clients = this.broker.channels[channel];
+  clients.splice(clients.indexOf(this), 1);
+  if (!clients.length) delete this.broker.channels[channel];
+};
+
+// drop all subscriptions, e.g. when the worker behind the client died
+LocalClient.prototype.close = function() {
+  for (var channel in this.handlers) {
+    var handlers = this.handlers[channel].slice();
+    for (var i = 0; i < handlers.length; i++) this.unsubscribe(channel, handlers[i]);
+  }
+};
+
+LocalClient.prototype.receive = function(channel, message) {
+  var handlers = (this.handlers[channel] || []).slice();
+  for (var i = 0; i < handlers.length; i++) handlers[i](message);
+};
+
+// Worker side of the cluster broker: the same client API over process.send.
+var IpcBroker = function(port) {
+  this.port = port || process;
+  this.pending = {};    // request id -> callback
+  this.nextId = 1;
+  this.handlers = {};   // channel -> [handler]
+  var self = this;
+  this.port.on('message', function(msg) {
+    if (!msg || !msg.broker) return;
+    if (msg.broker == 'reply') {
+      var callback = self.pending[msg.id];
+      delete self.pending[msg.id];
+      if (callback) callback(msg.error ? new Error(msg.error) : null, msg.value);
+    } else if (msg.broker == 'message') {
+      self.receive(msg.channel, msg.message);
+    }
+  });
+};
+
+IpcBroker.prototype.request = function(op, fields, callback) {
+  fields.broker = 'request';
+  fields.op = op;
+  if (callback) {
+    fields.id = this.nextId++;
+    this.pending[fields.id] = callback;
+  }
+  this.port.send(fields);
+};
+
+IpcBroker.prototype.get = function(key, callback) {
+  this.request('get', {key: key}, callback);
+};
+
+IpcBroker.prototype.set = function(key, value, callback) {
+  this.request('set', {key: key, value: value}, callback);
+};
+
+IpcBroker.prototype.remove = function(key, callback) {
+  this.request('remove', {key: key}, callback);
+};
+
+IpcBroker.prototype.keys = function(prefix, callback) {
+  this.request('keys', {prefix: prefix}, callback);
+};
+
+IpcBroker.prototype.publish = function(channel, message) {
+  this.port.send({broker: 'publish', channel: channel, message: message});
+};
+
+IpcBroker.prototype.subscribe = function(channel, handler) {
+  if (!this.handlers[channel]) {
+    this.handlers[channel] = [];
+    this.port.send({broker: 'subscribe', channel: channel});
+  }
+  this.handlers[channel].push(handler);
+};
+
+IpcBroker.prototype.unsubscribe = function(channel, handler) {
+  var handlers = this.handlers[channel];
+  if (!handlers) return;
+  var i = handlers.indexOf(handler);
+  if (i != -1) handlers.splice(i, 1);
+  if (handlers.length) return;
+  delete this.handlers[channel];
+  this.port.send({broker: 'unsubscribe', channel: channel});
+};
+
+IpcBroker.prototype.receive = LocalClient.prototype.receive;
+
+// Master side: answer the IpcBroker of one worker from the LocalBroker.
+function serveBroker(broker, worker) {
+  var client = broker.connect();
+  var forwarders = {};  // channel -> handler sending the channel's messages to the worker
+  worker.on('message', function(msg) {
+    if (!msg || !msg.broker) return;
+    if (msg.broker == 'request') {
+      var reply = function(err, value) {
+        if (msg.id) worker.send({broker: 'reply', id: msg.id, error: err && err.message, value: value});
+      };
+      if (msg.op == 'get') client.get(msg.key, reply);
+      else if (msg.op == 'set') client.set(msg.key, msg.value, reply);
+      else if (msg.op == 'remove') client.remove(msg.key, reply);
+      else if (msg.op == 'keys') client.keys(msg.prefix, reply);
+      else reply(new Error('unknown broker request ' + msg.op));
+    } else if (msg.broker == 'publish') {
+      client.publish(msg.channel, msg.message);
+    } else if (msg.broker == 'subscribe' && !forwarders[msg.channel]) {
+      forwarders[msg.channel] = function(message) {
+        if (worker.isConnected()) worker.send({broker: 'message', channel: msg.channel, message: message});
+      };
+      client.subscribe(msg.channel, forwarders[msg.channel]);
+    } else if (msg.broker == 'unsubscribe' && forwarders[msg.channel]) {
+      client.unsubscribe(msg.channel, forwarders[msg.channel]);
+      delete forwarders[msg.channel];
+    }
+  });
+  worker.on('exit', function() { client.close(); });
+  return client;
+}
+
+exports.LocalBroker = LocalBroker;
+exports.IpcBroker = IpcBroker;
+exports.serveBroker = serveBroker;
@@ -0,0 +1,156 @@
+var EventEmitter = require('events').EventEmitter,
+    fs = require('fs'),
+    logger = require('./logger').logger;
+
+// Persistent catalog of the scores in Uploads/. Entries come from the
+// header-only pass of xml2abc.py (-i): title, composer, part names, MIDI
+// programs and the number of parts and measures. Only new or changed files
+// are read, several per python process, and the result is kept in a JSON
+// file so a restart does not have to read the library again.
+//
+// Emits 'entry' (entry) when an entry is added or changed and 'remove'
+// (file) when a score is gone. In a cluster one process keeps the catalog;
+// the others are readOnly: they neither read the scores nor write
+// catalogFile, and follow that process's events through set and remove.
+var Catalog = function(exec, uploadDir, catalogFile) {
+  EventEmitter.call(this);
+  this.exec = exec;
+  this.uploadDir = uploadDir;
+  this.catalogFile = catalogFile;
+  this.entries = {};    // file name -> entry
+  this.pending = [];    // files waiting for the next header pass
+  this.scanning = false;
+  this.batchSize = 50;  // files per xml2abc process
+  this.saveTimer = null;
+  this.readOnly = false;  // another process keeps the catalog
+};
+
+Catalog.prototype.__proto__ = EventEmitter.prototype;
+
+function isScore(file) {
+  return /\.(xml|mxl)$/i.test(file);
+}
+
+// read the stored catalog, then bring it up to date with Uploads/
+Catalog.prototype.load = function(callback) {
+  var self = this;
+  fs.readFile(this.catalogFile, 'utf8', function(err, data) {
+    if (!err) {
+      try { var stored = JSON.parse(data); }
+      catch (e) { stored = {}; }
+      for (var file in stored) {      // entries that arrived meanwhile are newer
+        if (!self.entries[file]) self.entries[file] = stored[file];
+      }
+    }
+    if (self.readOnly) return callback && callback(null);
+    self.refresh(callback);
+  });
+};
+
+Catalog.prototype.refresh = function(callback) {
+  var self = this;
+  fs.readdir(this.uploadDir, function(err, files) {
+    if (err) return callback && callback(err);
+    var present = {};
+    files.filter(isScore).forEach(function(file) {
+      present[file] = true;
+      self.update(file);
+    });
+    for (var file in self.entries) {
+      if (present[file]) continue;
+      delete self.entries[file];
+      self.emit('remove', file);
+    }
+    self.save();
+    if (callback) callback(null);
+  });
+};
+
+// (re)read one file if it is new or changed since it was catalogued
+Catalog.prototype.update = function(file) {
+  if (this.readOnly || !isScore(file)) return;
+  var self = this;
+  fs.stat(this.uploadDir + file, function(err, stat) {
+    if (err) return;
+    var entry = self.entries[file];
+    var mtime = stat.mtime.getTime();
+    if (entry && entry.mtime == mtime && entry.size == stat.size) return;
+    if (!entry) self.entries[file] = {file: file};   // listed right away, details follow
+    self.entries[file].mtime = mtime;
+    self.entries[file].size = stat.size;
+    self.entries[file].scanned = false;
+    self.emit('entry', self.entries[file]);
+    if (self.pending.indexOf(file) == -1) self.pending.push(file);
+    self.scan();
+  });
+};
+
+Catalog.prototype.scan = function() {
+  if (this.scanning || this.pending.length == 0) return;
+  this.scanning = true;
+  var batch = this.pending.splice(0, this.batchSize);
+  var args = ['python', 'xml2abc.py', '-i'];
+  for (var i = 0; i < batch.length; i++) args.push(this.uploadDir + batch[i]);
+  var self = this;
+  this.exec(args, function(err, out, code) {
+    var lines = err instanceof Error ? [] : String(out).split('\n');
+    for (var i = 0; i < lines.length; i++) {
+      if (!lines[i]) continue;
+      try { var meta = JSON.parse(lines[i]); }
+      catch (e) { continue; }
+      var entry = self.entries[meta.file];
+      if (!entry) continue;                 // removed while we were reading it
+      for (var key in meta) entry[key] = meta[key];
+      entry.scanned = true;
+      self.emit('entry', entry);
+    }
+    self.scanning = false;
+    self.save();
+    self.scan();
+  });
+};
+
+// an entry from the process that keeps the catalog
+Catalog.prototype.set = function(entry) {
+  this.entries[entry.file] = entry;
+};
+
+Catalog.prototype.remove = function(file) {
+  delete this.entries[file];
+};
+
+// write the catalog at most once a second
+Catalog.prototype.save = function() {
+  if (this.readOnly || this.saveTimer) return;
+  var self = this;
+  this.saveTimer = setTimeout(function() {
+    self.saveTimer = null;
+    fs.writeFile(self.catalogFile, JSON.stringify(self.entries), function(err) {
+      if (err) logger.error('Error saving catalog: %s', err.message);
+    });
+  }, 1000);
+};
+
+function matches(entry, filter) {
+  var fields = [entry.file, entry.title, entry.movement].concat(entry.composer || [], entry.lyricist || []);
+  (entry.parts || []).forEach(function(part) { fields.push(part.name); });
+  return fields.join('\n').toLowerCase().indexOf(filter) != -1;
+}
+
+// one page of the catalog: {total, page, pageSize, items}; pageSize 0 = everything
+Catalog.prototype.list = function(options) {
+  options = options || {};
+  var filter = String(options.filter || '').toLowerCase();
+  var page = Math.max(0, parseInt(options.page, 10) || 0);
+  var pageSize = Math.max(0, parseInt(options.pageSize, 10) || 0);
+  var items = [];
+  for (var file in this.entries) {
+    if (!filter || matches(this.entries[file], filter)) items.push(this.entries[file]);
+  }
+  items.sort(function(a, b) { return a.file < b.file ? -1 : a.file > b.file ? 1 : 0; });
+  var total = items.length;
+  if (pageSize) items = items.slice(page * pageSize, (page + 1) * pageSize);
+  return {total: total, page: page, pageSize: pageSize, items: items};
+};
+
+exports.Catalog = Catalog;
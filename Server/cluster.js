@@ -0,0 +1,79 @@
+var cluster = require('cluster'),
+    net = require('net'),
+    os = require('os'),
+    exec = require('exec'),
+    LocalBroker = require('./broker').LocalBroker,
+    serveBroker = require('./broker').serveBroker,
+    Converter = require('./converter').Converter,
+    metrics = require('./metrics').metrics,
+    logger = require('./logger').logger;
+
+// Master of `node index.js --cluster [--workers N] [--balance address|connection]`.
+//
+// It forks one index.js worker per core (or N) and forks a new one when a
+// worker dies. The master owns the broker the workers share their sessions
+// through and the one conversion pool all of them use, and it accepts the
+// connections itself to hand each one to a worker:
+//   address     all connections from one client address go to the same
+//               worker, which socket.io's polling transport needs (default)
+//   connection  round robin, for clients that only use websockets
+function master(options) {
+  var count = options.workers || os.cpus().length;
+  var broker = new LocalBroker();
+  var converter = new Converter(exec, __dirname + '/Uploads/', {indexTerms: true});
+  var workers = [];     // worker index -> cluster worker
+  var next = 0, stopping = false;
+
+  function sendAll(msg) {
+    workers.forEach(function(worker) {
+      if (worker.isConnected()) worker.send(msg);
+    });
+  }
+  converter.on('status', function(job) { sendAll({converter: 'status', job: job}); });
+  converter.on('forget', function(job) { sendAll({converter: 'forget', job: job}); });
+  converter.on('terms', function(file, terms) { sendAll({converter: 'terms', file: file, terms: terms}); });
+
+  function fork(index) {
+    var worker = cluster.fork({WORKER_INDEX: String(index)});
+    workers[index] = worker;
+    serveBroker(broker, worker);
+    converter.serve(worker);
+    metrics.serve(worker, workers);
+    worker.on('exit', function(code, signal) {
+      if (stopping) {
+        if (workers.every(function(w) { return !w.isConnected(); })) logger.flush(function() { process.exit(0); });
+        return;
+      }
+      logger.warn('worker %d exited (%s), restarting', index, signal || code);
+      fork(index);
+    });
+  }
+  for (var i = 0; i < count; i++) fork(i);
+
+  function pick(conn) {
+    if (options.balance == 'connection') return workers[next++ % count];
+    var address = conn.remoteAddress || '', hash = 0;
+    for (var i = 0; i < address.length; i++) hash = (hash * 31 + address.charCodeAt(i)) | 0;
+    return workers[Math.abs(hash) % count];
+  }
+
+  var server = net.createServer({pauseOnConnect: true}, function(conn) {
+    var worker = pick(conn);
+    if (!worker.isConnected()) return conn.destroy();
+    worker.send('sticky-connection', conn);
+  });
+  server.listen(options.port, function() {
+    logger.info('listening on *:%s with %d workers', options.port, count);
+  });
+
+  // let every worker write out its annotations first
+  process.on('SIGINT', function() {
+    stopping = true;
+    server.close();
+    workers.forEach(function(worker) {
+      if (worker.isConnected()) worker.process.kill('SIGINT');
+    });
+  });
+}
+
+exports.master = master;
@@ -1,13 +1,24 @@
-var ObjectID = require('mongodb').ObjectID;
+var ObjectID = require('mongodb').ObjectID,
+    metrics = require('./metrics').metrics,
+    since = require('./metrics').since;
+
+var saveTime = metrics.histogram('annotation_save_seconds', 'Time to store annotations, per insert');
+var saved = metrics.counter('annotations_saved_total', 'Annotations stored');
 
 CollectionDriver = function(db) {
   this.db = db;
+  this.collections = {};  // collection handles, looked up once per name
 };
 
 CollectionDriver.prototype.getCollection = function(collectionName, callback) {
+  var collections = this.collections;
+  if (collections[collectionName]) return callback(null, collections[collectionName]);
   this.db.collection(collectionName, function(error, the_collection) {
     if( error ) callback(error);
-    else callback(null, the_collection);
+    else {
+      collections[collectionName] = the_collection;
+      callback(null, the_collection);
+    }
   });
 };
 
@@ -51,17 +62,40 @@ CollectionDriver.prototype.getDistinct = function(collectionName, callback) {
        	
 //save new object
 CollectionDriver.prototype.save = function(collectionName, obj, callback) {
+    var started = process.hrtime();
     this.getCollection(collectionName, function(error, the_collection) { //A
       if( error ) callback(error)
       else {
         obj.created_at = new Date(); //B
         the_collection.insert(obj, function() { //C
+          saveTime.observe({op: 'save'}, since(started));
+          saved.inc();
           callback(null, obj);
         });
       }
     });
 };
 
+//save a batch of new objects with one insert
+CollectionDriver.prototype.saveAll = function(collectionName, objs, callback) {
+    var started = process.hrtime();
+    this.getCollection(collectionName, function(error, the_collection) {
+      if( error ) callback(error)
+      else {
+        var now = new Date();
+        for (var i = 0; i < objs.length; i++) objs[i].created_at = now;
+        the_collection.insert(objs, function(error) {
+          saveTime.observe({op: 'saveAll'}, since(started));
+          if (error) callback(error);
+          else {
+            saved.inc(null, objs.length);
+            callback(null, objs);
+          }
+        });
+      }
+    });
+};
+
 //update a specific object
 CollectionDriver.prototype.update = function(collectionName, obj, entityId, callback) {
     this.getCollection(collectionName, function(error, the_collection) {
@@ -0,0 +1,410 @@
+var EventEmitter = require('events').EventEmitter,
+    fs = require('fs'),
+    os = require('os'),
+    path = require('path'),
+    metrics = require('./metrics').metrics,
+    since = require('./metrics').since;
+
+var queueTime = metrics.histogram('conversion_queue_seconds', 'Time a conversion waited for a slot');
+var runTime = metrics.histogram('conversion_run_seconds', 'Time a conversion took, from its start to the ABC');
+var rejected = metrics.counter('conversions_rejected_total', 'Background conversions refused because the queue was full');
+
+// Runs xml2abc.py on uploaded scores and keeps the ABC it produced. Requests
+// for a file that is already being converted wait for that conversion
+// instead of starting another one.
+//
+// Conversions run through a queue with a limited number of slots. Requests
+// from open pages (convert) go first; background jobs for new uploads
+// (enqueue) only take up to backgroundLimit slots and their queue is
+// bounded, so a flood of uploads cannot starve live sessions.
+//
+// A conversion can be limited to some parts and voices of the score
+// ({parts: [ids, numbers or names], voices: [numbers]}); each selection is
+// converted and cached on its own.
+//
+// Finished jobs are kept for the maxCached most recently used keys only,
+// since every selection a client asks for makes a key of its own.
+//
+// Emits 'status' (job) whenever a job changes state, 'forget' (job) when a
+// finished job is evicted, and 'converted' (file, abc, selection) after
+// every successful conversion. With the
+// indexTerms option, conversions of a whole score also emit 'terms' (file,
+// terms): the search terms xml2abc.py -x collected while converting it.
+// A Standard MIDI File (xml2abc.py --midi), for players that cannot render
+// ABC, is only made when somebody asks for it (see midi): it is a job of
+// its own, so the conversions people wait for on open pages stay fast.
+var Converter = function(exec, uploadDir, options) {
+  EventEmitter.call(this);
+  options = options || {};
+  this.exec = exec;
+  this.uploadDir = uploadDir;
+  this.concurrency = options.concurrency || os.cpus().length;
+  this.backgroundLimit = options.backgroundLimit || 1;
+  this.maxQueued = options.maxQueued || 100;
+  this.indexTerms = !!options.indexTerms;
+  this.maxCached = options.maxCached || 200;
+  this.outputSeq = 0;   // names the files xml2abc.py writes terms and MIDI to
+  this.cache = {};      // job key -> ABC string
+  this.midiCache = {};  // job key -> Standard MIDI File (Buffer)
+  this.inflight = {};   // job key -> callbacks waiting for the queued or running conversion
+  this.versions = {};   // file name -> number of times it was invalidated
+  this.jobs = {};       // job key -> {file, selection, state, background, queuedAt, startedAt, finishedAt, error}
+  this.finished = {};   // job keys of finished jobs, least recently used first
+  this.finishedCount = 0;
+  this.queue = [];      // job keys waiting for an interactive slot
+  this.backgroundQueue = [];
+  this.running = 0;
+  this.runningBackground = 0;
+};
+
+Converter.prototype.__proto__ = EventEmitter.prototype;
+
+// normalized selection string, '' for the whole score: "parts=P1,2;voices=1"
+function selectionString(selection) {
+  if (!selection) return '';
+  var fields = [];
+  ['parts', 'voices'].forEach(function(name) {
+    var list = [].concat(selection[name] || []).map(function(x) { return String(x).trim(); });
+    list = list.filter(function(x) { return x && x.indexOf(',') == -1 && x.indexOf(';') == -1; });
+    if (name == 'voices') list = list.filter(function(x) { return /^\d+$/.test(x); });
+    if (list.length) fields.push(name + '=' + list.sort().join(','));
+  });
+  return fields.join(';');
+}
+
+// MIDI is made with repeats unfolded (-u), so that it plays the whole piece
+function jobKey(file, sel, midi) {
+  return (midi ? 'midi-u:' : '') + (sel ? file + '#' + sel : file);
+}
+
+// an error if file cannot name a score in the upload directory
+function badFile(file) {
+  if (typeof file != 'string' || !file) return new Error('no score file given');
+  return null;
+}
+
+// convert(file, [selection], callback)
+Converter.prototype.convert = function(file, selection, callback) {
+  if (typeof selection == 'function') { callback = selection; selection = null; }
+  if (badFile(file)) return callback(badFile(file));
+  var sel = selectionString(selection), key = jobKey(file, sel);
+  if (this.cache[key] != null) {
+    this.touch(key);
+    return callback(null, this.cache[key]);
+  }
+  this.request(key, {file: file, selection: sel}, callback);
+};
+
+// wait for the job of key, queueing it in the front lane if there is none
+Converter.prototype.request = function(key, fields, callback) {
+  if (this.inflight[key]) {
+    this.inflight[key].push(callback);
+    var i = this.backgroundQueue.indexOf(key);
+    if (i != -1) {        // somebody is waiting for it now: move it to the front lane
+      this.backgroundQueue.splice(i, 1);
+      this.jobs[key].background = false;
+      this.queue.push(key);
+      this.pump();
+    }
+    return;
+  }
+  this.inflight[key] = [callback];
+  fields.background = false;
+  fields.queuedAt = Date.now();
+  this.setStatus(key, 'queued', fields);
+  this.queue.push(key);
+  this.pump();
+};
+
+// queue a background conversion of a new upload; callback(err, abc) is optional
+Converter.prototype.enqueue = function(file, callback) {
+  callback = callback || function() {};
+  if (badFile(file)) return callback(badFile(file));
+  if (this.cache[file] != null) {
+    this.touch(file);
+    return callback(null, this.cache[file]);
+  }
+  if (this.inflight[file]) return this.inflight[file].push(callback);
+  if (this.backgroundQueue.length >= this.maxQueued) {
+    rejected.inc();
+    this.setStatus(file, 'failed', {file: file, selection: '', background: true, error: 'conversion queue is full'});
+    return callback(new Error('conversion queue is full'));
+  }
+  this.inflight[file] = [callback];
+  this.setStatus(file, 'queued', {file: file, selection: '', background: true, queuedAt: Date.now()});
+  this.backgroundQueue.push(file);
+  this.pump();
+};
+
+Converter.prototype.pump = function() {
+  while (this.running < this.concurrency) {
+    var key;
+    if (this.queue.length) key = this.queue.shift();
+    else if (this.backgroundQueue.length && this.runningBackground < this.backgroundLimit) key = this.backgroundQueue.shift();
+    else return;
+    this.run(key);
+  }
+};
+
+Converter.prototype.run = function(key) {
+  var waiting = this.inflight[key];
+  var job = this.jobs[key];
+  var file = job.file, sel = job.selection, midiJob = !!job.midi;
+  var version = this.versions[file];
+  var background = job.background;
+  var lane = background ? 'background' : 'interactive';
+  var started = process.hrtime();
+  var self = this;
+  queueTime.observe({lane: lane}, (Date.now() - job.queuedAt) / 1000);
+  this.running++;
+  if (background) this.runningBackground++;
+  this.setStatus(key, 'running', {startedAt: Date.now()});
+
+  function done(err, out, terms, midi) {
+    runTime.observe({lane: lane, result: err ? 'failed' : 'done'}, since(started));
+    self.running--;
+    if (background) self.runningBackground--;
+    if (self.inflight[key] == waiting) delete self.inflight[key];
+    var current = self.versions[file] == version;   // not replaced meanwhile
+    if (current) self.touch(key);
+    else if (!self.inflight[key] && self.jobs[key] == job) self.forget(key);
+    if (!err && midiJob && !midi) err = new Error('no MIDI written');
+    if (err) {
+      if (current) self.setStatus(key, 'failed', {finishedAt: Date.now(), error: String(err.message || err)});
+      for (var i = 0; i < waiting.length; i++) waiting[i](err);
+    } else if (midiJob) {
+      if (current) {
+        self.midiCache[key] = midi;
+        self.setStatus(key, 'done', {finishedAt: Date.now()});
+      }
+      for (var i = 0; i < waiting.length; i++) waiting[i](null, midi);
+    } else {
+      if (current) {
+        self.cache[key] = out;
+        self.setStatus(key, 'done', {finishedAt: Date.now()});
+        self.emit('converted', file, out, sel);
+        if (terms) self.emit('terms', file, terms);
+      }
+      for (var i = 0; i < waiting.length; i++) waiting[i](null, out);
+    }
+    self.pump();
+  }
+
+  var args = ['python', 'xml2abc.py'];
+  sel.split(';').forEach(function(field) {      // parts=... -> --parts=...
+    if (field) args.push('--' + field);
+  });
+  var output = path.join(os.tmpdir(), 'xml2abc-' + process.pid + '-' + (this.outputSeq++));
+  var termsFile = this.indexTerms && !sel && !midiJob ? output + '.json' : null;
+  var midiFile = midiJob ? output + '.mid' : null;
+  if (termsFile) args.push('-x', termsFile);
+  if (midiFile) args.push('-u', '--midi', midiFile);
+  args.push(this.uploadDir + file);
+  function failed(err) {    // xml2abc may have written some of its files before it failed
+    [termsFile, midiFile].forEach(function(file) {
+      if (file) fs.unlink(file, function() {});
+    });
+    done(err);
+  }
+  this.validate(file, function(err) {
+    if (err) return done(err);
+    self.exec(args, function(err, out, code) {
+      if (err instanceof Error) return failed(err);
+      if (!out) return failed(new Error(String(err || 'no ABC written').trim()));  // xml2abc reports on stderr
+      readOutput(termsFile, null, function(terms) {
+        try { terms = terms && JSON.parse(terms); }
+        catch (e) { terms = null; }
+        readOutput(midiFile, 'binary', function(midi) { done(null, out, terms, midi); });
+      });
+    });
+  });
+};
+
+// a file xml2abc.py wrote next to the ABC (a Buffer for 'binary', else a
+// string), null if there is none; removes the file
+function readOutput(file, encoding, callback) {
+  if (!file) return callback(null);
+  fs.readFile(file, function(err, data) {
+    if (err) return callback(null);
+    fs.unlink(file, function() {});
+    callback(encoding == 'binary' ? data : data.toString('utf8'));
+  });
+}
+
+// cheap check that a file is MusicXML that xml2abc can read, before forking python
+Converter.prototype.validate = function(file, callback) {
+  if (badFile(file)) return callback(badFile(file));
+  var ext = file.slice(file.lastIndexOf('.')).toLowerCase();
+  if (ext != '.xml' && ext != '.mxl') return callback(new Error('not a .xml or .mxl file'));
+  fs.open(this.uploadDir + file, 'r', function(err, fd) {
+    if (err) return callback(err.code == 'ENOENT' ? new Error('no such score: ' + file) : err);
+    var head = Buffer.alloc(2048);
+    fs.read(fd, head, 0, head.length, 0, function(err, length) {
+      fs.close(fd, function() {});
+      if (err) return callback(err);
+      var text = head.toString('binary', 0, length);
+      if (head[0] == 0xfe && head[1] == 0xff) text = Buffer.from(head.slice(0, length & ~1)).swap16().toString('utf16le');
+      else if (head[0] == 0xff && head[1] == 0xfe) text = head.toString('utf16le', 0, length & ~1);
+      if (ext == '.mxl') {
+        if (text.slice(0, 2) != 'PK') return callback(new Error('not a compressed MusicXML file'));
+      } else if (text.indexOf('<score-timewise') != -1) {
+        return callback(new Error('timewise MusicXML is not supported'));
+      } else if (text.indexOf('<score-partwise') == -1) {
+        return callback(new Error('not a MusicXML score'));
+      }
+      callback(null);
+    });
+  });
+};
+
+// midi(file, [selection], callback): the Standard MIDI File of the score,
+// made by a job of its own the first time it is asked for
+Converter.prototype.midi = function(file, selection, callback) {
+  if (typeof selection == 'function') { callback = selection; selection = null; }
+  if (badFile(file)) return callback(badFile(file));
+  var sel = selectionString(selection), key = jobKey(file, sel, true);
+  if (this.midiCache[key]) {
+    this.touch(key);
+    return callback(null, this.midiCache[key]);
+  }
+  this.request(key, {file: file, selection: sel, midi: true}, callback);
+};
+
+// mark a finished job as just used, evicting the least recently used ones
+Converter.prototype.touch = function(key) {
+  if (this.finished[key]) delete this.finished[key];
+  else this.finishedCount++;
+  this.finished[key] = true;
+  for (var oldest in this.finished) {
+    if (this.finishedCount <= this.maxCached) break;
+    delete this.finished[oldest];
+    this.finishedCount--;
+    delete this.cache[oldest];
+    delete this.midiCache[oldest];
+    if (!this.inflight[oldest]) this.forget(oldest);   // unless it is converting again
+  }
+};
+
+Converter.prototype.setStatus = function(key, state, fields) {
+  var job = this.jobs[key] || (this.jobs[key] = {file: key, selection: ''});
+  job.state = state;
+  if (state == 'queued') job.startedAt = job.finishedAt = job.error = undefined;
+  for (var key in fields) job[key] = fields[key];
+  this.emit('status', job);
+};
+
+Converter.prototype.status = function(file, selection) {
+  return this.jobs[jobKey(file, selectionString(selection))] || null;
+};
+
+// forget the ABC of a file and all its selections, e.g. when a new version is uploaded
+Converter.prototype.invalidate = function(file) {
+  this.versions[file] = (this.versions[file] || 0) + 1;
+  for (var key in this.jobs) {
+    if (this.jobs[key].file != file) continue;
+    delete this.cache[key];
+    delete this.midiCache[key];
+    if (this.finished[key]) {
+      delete this.finished[key];
+      this.finishedCount--;
+    }
+    if (!this.inflight[key]) {
+      this.forget(key);
+      continue;
+    }
+    var i = this.queue.indexOf(key), j = this.backgroundQueue.indexOf(key);
+    if (i == -1 && j == -1) delete this.inflight[key];  // running: let it finish, but uncached
+  }
+};
+
+Converter.prototype.forget = function(key) {
+  var job = this.jobs[key];
+  if (!job) return;
+  delete this.jobs[key];
+  this.emit('forget', job);
+};
+
+// Master side of the pool shared by the workers of a cluster: run the
+// conversions a worker's RemoteConverter asks for.
+Converter.prototype.serve = function(worker) {
+  var self = this;
+  worker.on('message', function(msg) {
+    if (!msg || !msg.converter) return;
+    if (msg.converter == 'convert') {
+      self.convert(msg.file, msg.selection, function(err, abc) {
+        if (!worker.isConnected()) return;
+        worker.send({converter: 'converted', id: msg.id, error: err ? String(err.message || err) : null, abc: abc});
+      });
+    } else if (msg.converter == 'midi') {
+      self.midi(msg.file, msg.selection, function(err, midi) {
+        if (!worker.isConnected()) return;
+        worker.send({converter: 'converted', id: msg.id, error: err ? String(err.message || err) : null,
+                     midi: midi ? midi.toString('base64') : null});
+      });
+    } else if (msg.converter == 'enqueue') {
+      self.enqueue(msg.file);
+    } else if (msg.converter == 'invalidate') {
+      self.invalidate(msg.file);
+    }
+  });
+};
+
+// Worker side: the Converter API, with the conversions run by the master.
+// Job states are mirrored from the 'status' messages the master sends to
+// every worker, so status() stays synchronous; 'terms' are passed on too.
+var RemoteConverter = function(port) {
+  EventEmitter.call(this);
+  this.port = port || process;
+  this.jobs = {};       // job key -> last known job state
+  this.pending = {};    // request id -> callback
+  this.nextId = 1;
+  var self = this;
+  this.port.on('message', function(msg) {
+    if (!msg || !msg.converter) return;
+    if (msg.converter == 'status') {
+      self.jobs[jobKey(msg.job.file, msg.job.selection, msg.job.midi)] = msg.job;
+      self.emit('status', msg.job);
+    } else if (msg.converter == 'forget') {
+      delete self.jobs[jobKey(msg.job.file, msg.job.selection, msg.job.midi)];
+    } else if (msg.converter == 'terms') {
+      self.emit('terms', msg.file, msg.terms);
+    } else if (msg.converter == 'converted') {
+      var callback = self.pending[msg.id];
+      delete self.pending[msg.id];
+      if (!callback) return;
+      if (msg.error) callback(new Error(msg.error));
+      else callback(null, 'midi' in msg ? Buffer.from(msg.midi, 'base64') : msg.abc);
+    }
+  });
+};
+
+RemoteConverter.prototype.__proto__ = EventEmitter.prototype;
+
+RemoteConverter.prototype.convert = function(file, selection, callback) {
+  if (typeof selection == 'function') { callback = selection; selection = null; }
+  if (badFile(file)) return callback(badFile(file));
+  var id = this.nextId++;
+  this.pending[id] = callback;
+  this.port.send({converter: 'convert', id: id, file: file, selection: selection});
+};
+
+RemoteConverter.prototype.midi = function(file, selection, callback) {
+  if (typeof selection == 'function') { callback = selection; selection = null; }
+  if (badFile(file)) return callback(badFile(file));
+  var id = this.nextId++;
+  this.pending[id] = callback;
+  this.port.send({converter: 'midi', id: id, file: file, selection: selection});
+};
+
+RemoteConverter.prototype.enqueue = function(file) {
+  this.port.send({converter: 'enqueue', file: file});
+};
+
+RemoteConverter.prototype.invalidate = function(file) {
+  this.port.send({converter: 'invalidate', file: file});
+};
+
+RemoteConverter.prototype.status = Converter.prototype.status;
+
+exports.Converter = Converter;
+exports.RemoteConverter = RemoteConverter;
@@ -1,3 +1,24 @@
+var cluster = require('cluster'),
+    logger = require('./logger').logger,
+    metrics = require('./metrics').metrics;
+
+function option(name) {
+  var i = process.argv.indexOf(name);
+  return i == -1 ? null : (process.argv[i + 1] || '');
+}
+
+// --log-level error|warn|info|debug (or LOG_LEVEL); debug logs every socket event
+logger.setLevel(option('--log-level'));
+
+// --cluster: this process only forks and feeds the workers, see cluster.js
+if (process.argv.indexOf('--cluster') != -1 && cluster.isMaster) {
+  return require('./cluster').master({
+    port: process.env.PORT || 3000,
+    workers: Number(option('--workers')) || 0,
+    balance: option('--balance') || 'address'
+  });
+}
+
 var app = require('express')(),
     express = require('express'),
     http = require('http').Server(app),
@@ -11,26 +32,121 @@ var app = require('express')(),
 		bodyParser = require('body-parser')
 		exec = require('exec')
 		CollectionDriver = require('./collectionDriver').CollectionDriver;
+		AnnotationReplay = require('./annotationReplay').AnnotationReplay;
+		AnnotationStore = require('./annotationStore').AnnotationStore;
+		MemoryDb = require('./memoryDb').MemoryDb;
+		SessionManager = require('./sessionManager').SessionManager;
+		Converter = require('./converter').Converter;
+		RemoteConverter = require('./converter').RemoteConverter;
+		IpcBroker = require('./broker').IpcBroker;
+		Catalog = require('./catalog').Catalog;
+		SearchIndex = require('./search').SearchIndex;
+		Assets = require('./assets').Assets;
+		sendFile = require('./assets').sendFile;
+		path = require('path');
+
+if (cluster.isWorker) metrics.attach(process);     // /metrics is gathered by the master
+var socketsConnected = metrics.gauge('sockets_connected', 'Open socket.io connections');
+metrics.gauge('sessions', 'Sessions known to this process', function() { return sessions.names().length; });
+
+// a cluster worker shares sessions through the master's broker and converts in its pool
+var workerIndex = cluster.isWorker ? Number(process.env.WORKER_INDEX) : null;
+var broker = cluster.isWorker ? new IpcBroker() : null;
+var sessions = new SessionManager(io, broker, {id: workerIndex});
+var converter = cluster.isWorker ? new RemoteConverter() : new Converter(exec, __dirname + '/Uploads/', {indexTerms: true});
+
+// the first worker reads the scores and passes the entries on to the others
+var catalog = new Catalog(exec, __dirname + '/Uploads/', __dirname + '/catalog.json');
+catalog.readOnly = workerIndex > 0;
+if (broker && !catalog.readOnly) {
+	catalog.on('entry', function(entry) { broker.publish('catalog', {"entry" : entry}); });
+	catalog.on('remove', function(file) { broker.publish('catalog', {"remove" : file}); });
+}
+catalog.load();
+
+// titles, composers and melodies of the library, updated as scores are converted
+var search = new SearchIndex(exec, __dirname + '/Uploads/', __dirname + '/search.json');
+search.readOnly = workerIndex > 0;
+converter.on('terms', function(file, terms) { search.add(file, terms); });
+search.load(function() {
+	if (search.readOnly) return;     // the first worker indexes the scores nobody converted yet
+	fs.readdir(__dirname + '/Uploads/', function(err, files) {
+		if (err) return;
+		search.backfill(files, function(file, terms) {
+			if (broker) broker.publish('search terms', {"file" : file, "terms" : terms});
+		});
+	});
+});
+
+// a score was uploaded, here or to another worker
+function scoreChanged(filename) {
+	sessions.fileChanged(filename);
+	catalog.update(filename);
+}
+if (broker) {
+	broker.subscribe('uploads', function(msg) { scoreChanged(msg.file); });
+	broker.subscribe('search terms', function(msg) { search.add(msg.file, msg.terms); });
+	broker.subscribe('catalog', function(msg) {
+		if (msg.entry) catalog.set(msg.entry);
+		else catalog.remove(msg.remove);
+	});
+	// annotations saved by other workers, for the late joiners of this one; the
+	// logs of sessions without members here are read from the database on joining
+	broker.subscribe('annotations', function(msg) {
+		if (annotationReplay && sessions.following(msg.collection)) annotationReplay.record(msg.collection, msg.annotation);
+	});
+}
 
-var sockets = [];
-var sessionSockets = [];
+// uploaders follow their score's conversion job in the 'conversion:<file>' room
+converter.on('status', function(job) {
+	if (!job.midi) io.to('conversion:' + job.file).emit('Conversion Status', job);
+});
 var sessionFile = null;
 var studentFile = null;
-var session = null;
 
 var mongoHost = 'localHost'; 
 var mongoPort = 27017; 
 var collectionDriver;
+var annotationReplay;
+var annotationStore;
 
- 
-var mongoClient = new MongoClient(new Server(mongoHost, mongoPort)); 
-mongoClient.open(function(err, mongoClient) { 
-  if (!mongoClient) {
-      console.error("Error! Exiting... Must start MongoDB first");
-      process.exit(1); 
-  }
-  var db = mongoClient.db("MyDatabase");  
+function openDatabase(db) {
   collectionDriver = new CollectionDriver(db); 
+  annotationReplay = new AnnotationReplay(collectionDriver, {idPrefix: broker ? 'w' + workerIndex + '.' : ''});
+  annotationStore = new AnnotationStore(collectionDriver);
+}
+
+// the last member of a session left: keep its annotations in the database only,
+// once the ones still buffered are written
+sessions.on('empty', function(room) {
+  if (!room.collection || !annotationStore) return;
+  annotationStore.flush(room.collection, function() {
+    if (!sessions.following(room.collection)) annotationReplay.drop(room.collection);
+  });
+});
+
+// no mongod needed, annotations last as long as the process; every worker of a
+// cluster has a database of its own, so late joiners only see what was saved
+// by their own worker or while it followed the session
+if (process.argv.indexOf('--memory-db') != -1) {
+  openDatabase(new MemoryDb());
+} else {
+  var mongoClient = new MongoClient(new Server(mongoHost, mongoPort)); 
+  mongoClient.open(function(err, mongoClient) { 
+    if (!mongoClient) {
+        logger.error("Error! Exiting... Must start MongoDB first");
+        logger.flush(function() { process.exit(1); });
+        return;
+    }
+    openDatabase(mongoClient.db("MyDatabase"));
+  });
+}
+
+// write out the buffered annotations before going down
+process.on('SIGINT', function() {
+  function exit() { logger.flush(function() { process.exit(0); }); }
+  if (!annotationStore) return exit();
+  annotationStore.flushAll(exit);
 });
 
 app.use(busboy()); 
@@ -41,58 +157,94 @@ app.use(bodyParser.urlencoded({
 
 app.use(bodyParser.json());
 
+// scripts, styles, images and pages: read, hashed and compressed once at startup
+var assets = new Assets(__dirname, {
+	skip: ['Uploads', 'node_modules', 'mongodb'],
+	scripts: ['abcjs_basic_1.2-min.js', 'abcjs_basic_1.4-min.js', 'jquery-ui.js', 'annotationCodec.js']
+});
+assets.load();
+app.use(assets.middleware());
+
 var collection, studentCollection, teacherCollection;
 app.get('/', function(req, res){	
   //res.sendFile(__dirname + '/test_ABC_rect.html');
-  res.sendFile(__dirname + '/home.html');
-  app.use(express.static(__dirname));
+  assets.sendPage(req, res, 'home.html');
 });
 
 
 app.get('/file', function(req, res){
 	reqResource=url.parse(req.url,true);
 	var query = reqResource.query;
-	console.log(query["filename"]);
-	
 	sessionFile = query["filename"];
-	console.log("sessionFile is "+ sessionFile + "\n");
+	logger.debug("sessionFile is %s", sessionFile);
 	var temp = sessionFile.split('.');
 	collection = temp[0];
 	teacherCollection = temp[0];
-	res.sendFile(__dirname + '/file/test_ABC_rect.html');
+	assets.sendPage(req, res, 'file/test_ABC_rect.html');
 });	
 
 app.post('/get-file', function(req, res) {
-	res.sendFile(__dirname + '/get-file/test_ABC_rect.html');
+	assets.sendPage(req, res, 'get-file/test_ABC_rect.html');
 });
 
-app.post('/download', function(req, res) {
+// GET answers conditional and range requests, e.g. resumed downloads
+function download(req, res) {
+	reqResource=url.parse(req.url,true);
+	var query = reqResource.query;
+	logger.debug("download %s", query["filename"]);
+	var file = __dirname + '/Uploads/' + path.basename(String(query["filename"]));
+  	sendFile(req, res, file);
+}
+app.get('/download', download);
+app.post('/download', download);
+	
+app.get('/conversion', function(req, res) {
 	reqResource=url.parse(req.url,true);
 	var query = reqResource.query;
-	console.log(query["filename"]);
-	var file = __dirname + '/Uploads/' + query["filename"];
-  	res.download(file); 	
+	var job = converter.status(query["filename"]);
+	if(job) res.json(job);
+	else res.status(404).json({"file" : query["filename"], "state" : "unknown"});
 });
 	
+// Prometheus metrics, for monitoring from this machine only
+app.get('/metrics', function(req, res) {
+	if (!/^(127\.|::1$|::ffff:127\.)/.test(req.connection.remoteAddress)) return res.status(403).end();
+	metrics.collect(function(err, text) {
+		res.set('Content-Type', 'text/plain; version=0.0.4');
+		res.send(text);
+	});
+});
+
+// the score (or ?parts=&voices= of it) as a Standard MIDI File, cached with its ABC
+app.get('/midi', function(req, res) {
+	var query = url.parse(req.url,true).query;
+	var selection = (query["parts"] || query["voices"]) ?
+		{"parts" : String(query["parts"] || '').split(','), "voices" : String(query["voices"] || '').split(',')} : null;
+	converter.midi(path.basename(String(query["filename"])), selection, function(err, midi) {
+		if(err) return res.status(404).end();
+		res.set('Content-Type', 'audio/midi');
+		res.set('Cache-Control', 'no-cache');
+		res.send(midi);
+	});
+});
+
 app.get('/studentfile', function(req,res) {	
 	reqResource=url.parse(req.url,true);
 	var query = reqResource.query;
-	console.log(query["filename"]);
-	console.log(query["filename"]);
+	logger.debug("studentFile is %s", query["filename"]);
 	studentFile = query["filename"];
 	var temp = studentFile.split('.');
 	studentCollection = temp[0];
-	res.sendFile(__dirname + '/get-file/test_ABC_rect.html');
+	assets.sendPage(req, res, 'get-file/test_ABC_rect.html');
 });
 
 app.post('/', function(request, response){
 
-    console.log(request.body.login);
-    console.log(request.body.password);
+    logger.debug("login %s", request.body.login);
     if(request.body.login == 'teacher') {
-   	  response.sendFile(__dirname + '/teacher.html');
+   	  assets.sendPage(request, response, 'teacher.html');
    	} else {
-   		response.sendFile(__dirname + '/student.html');
+   		assets.sendPage(request, response, 'student.html');
    	}
 
 });
@@ -100,14 +252,19 @@ app.post('/', function(request, response){
 //app.post('/file-upload/:designation', function(req, res) {
 app.post('/:designation', function(req, res) {
 	var fstream;
-	console.log("designation is " + req.params.designation + "\n");
+	logger.debug("designation is %s", req.params.designation);
     req.pipe(req.busboy);
     req.busboy.on('file', function (fieldname, file, filename) {
     if(filename != '') {
-        console.log("Uploading: " + filename); 
+        logger.info("Uploading: %s", filename);
         fstream = fs.createWriteStream(__dirname + '/Uploads/' + filename);
         file.pipe(fstream);
         fstream.on('close', function () {
+        	converter.invalidate(filename);     // a new version of the score
+        	converter.enqueue(filename);        // warm it up before anybody opens it
+        	scoreChanged(filename);
+        	if (broker) broker.publish('uploads', {"file" : filename});
+        	res.cookie('upload', filename);     // lets the page follow the conversion job
         	if(req.params.designation == "teacher") {
         		res.sendFile(__dirname + '/teacher.html');	
         	} else {
@@ -121,31 +278,62 @@ app.post('/:designation', function(req, res) {
 });
 
 
+// save an annotation event and pass it on to the rest of the sender's session
+// tell a client why it gets no ABC
+function abcError(socket, file, message) {
+	socket.emit('ABC Error', {"type" : "ABC Error", "name" : file || null, "error" : message});
+}
+
+function relayAnnotation(socket, event, JSONObj) {
+	var room = sessions.roomOf(socket);
+	var target = room ? room.collection : collection;
+	annotationReplay.record(target, JSONObj);
+	if (broker) broker.publish('annotations', {"collection" : target, "annotation" : JSONObj});
+	annotationStore.save(target, JSONObj, function(err,success) {
+		if (err) { logger.error('Error saving annotation to %s', target); }
+	});
+
+	if(room) {
+		sessions.broadcastAnnotation(room, event, JSONObj, socket);
+	} else {
+		socket.emit(event, JSONObj);
+	}
+}
+
 io.on('connection', function(socket){
-  console.log('a user connected');
-  sockets.push(socket);
+  logger.debug('a user connected');
+  socketsConnected.inc();
 
 	socket.on('Session', function(JSONObj){
-		console.log(JSONObj);
-		session = JSONObj.name;
-		sessionSockets.push(socket);
-		for (var i = 0; i < sockets.length; i++ ) {
-  			if(sockets[i] == socket) continue;
-  			sockets[i].emit('Session', JSONObj);
-  		}
+		logger.debug('Session %j', JSONObj);
+		sessions.create(JSONObj.name);
+		sessions.announce(socket, 'Session', JSONObj);
   	}); 
 
 	socket.on('Get Session', function(JSONObj){
-		console.log("Inside Get session\n");
-		if(session) {
-			var tempJSON = {"type" : "Session", "name" : session};
+		logger.debug("Get Session");
+		sessions.joinLobby(socket);
+		var names = sessions.names();
+		for (var i = 0; i < names.length; i++) {
+			var tempJSON = {"type" : "Session", "name" : names[i]};
 			socket.emit('Session', tempJSON);
 		}
 	});
 
+	socket.on('Get Conversion Status', function(JSONObj){
+		socket.join('conversion:' + JSONObj.file);
+		var job = converter.status(JSONObj.file);
+		if(job) socket.emit('Conversion Status', job);
+	});
+
+	// clients that can read packed annotation events say so before joining
+	socket.on('Wire', function(JSONObj){
+		sessions.negotiate(socket, JSONObj && JSONObj.formats);
+	});
+
   	socket.on('Join Session', function(JSONObj){
-  		console.log(JSONObj);
-  		sessionSockets.push(socket);
+  		logger.debug('Join Session %j', JSONObj);
+  		if(JSONObj && JSONObj.name) sessions.join(JSONObj.name, socket);
   	}); 	
 
   	/*socket.on('Join Session', function(JSONObj){
@@ -153,61 +341,69 @@ io.on('connection', function(socket){
   		res.sendFile(__dirname + sessionFile);
   	}); */
 
+	// {session | file, parts, voices}: parts and voices limit the ABC to a student's own part
 	socket.on('Get ABC', function(JSONObj){
-		if(JSONObj.session) {
-			console.log("Entered Get ABC with session\n");
-			exec(['python', 'xml2abc.py', __dirname + '/Uploads/' + sessionFile], function(err, out, code) {
-  			  if (err instanceof Error)
-    		 	 throw err; 	
-  		 	 	process.stdout.write(out);
-  		 	  var JSONObj = {"type" : "ABC", "name" : sessionFile, "value" : out};
-  		 	  
-  			  for (var i = 0; i < sockets.length; i++ ) {
-  		 	  	console.log("Sending ABC string\n");
-  				sockets[i].emit('ABC', JSONObj);
-  			  }	  
+		JSONObj = JSONObj || {};
+		var room = JSONObj.session && sessions.join(JSONObj.session, socket);
+		var selection = (JSONObj.parts || JSONObj.voices) ? {"parts" : JSONObj.parts, "voices" : JSONObj.voices} : null;
+		if(room) {
+			logger.debug("Get ABC in session %s", room.name);
+			if(JSONObj.file) sessions.setFile(room, JSONObj.file);  // the teacher opens a score, maybe another one
+			else if(!room.file) sessions.setFile(room, sessionFile);
+			if(room.abc != null && !selection) {      // late joiners get the session's ABC straight away
+				socket.emit('ABC', {"type" : "ABC", "name" : room.file, "value" : room.abc});
+				return;
+			}
+			var file = room.file, generation = room.generation;
+			if(!file) return abcError(socket, file, 'session ' + room.name + ' has no score yet');
+			converter.convert(file, selection, function(err, out) {
+  			  if (err) { logger.warn('Error converting %s: %s', file, err.message); return abcError(socket, file, err.message); }
+  		 	  if (room.generation == generation && !selection) room.abc = out;   // neither replaced nor uploaded again
+  		 	  socket.emit('ABC', {"type" : "ABC", "name" : file, "value" : out});
 			});	
 		}	else {
-			  	exec(['python', 'xml2abc.py', __dirname + '/Uploads/' + JSONObj.file], function(err, out, code) {
-  			  		if (err instanceof Error)
-    		 		 throw err; 	
-  		 	 		process.stdout.write(out);
+				if(!JSONObj.file) return abcError(socket, JSONObj.file, 'no session or score named');
+			  	converter.convert(JSONObj.file, selection, function(err, out) {
+  			  		if (err) { logger.warn('Error converting %s: %s', JSONObj.file, err.message); return abcError(socket, JSONObj.file, err.message); }
   		 	  		var tempJSON = {"type" : "ABC", "name" : JSONObj.file, "value" : out};
   		 	  		socket.emit('ABC', tempJSON);
 				});	
 		}
   	}); 
+  	// {page, pageSize, filter} -> one 'Music List Page' from the catalog
   	socket.on('Get File List', function(JSONObj){
-		exec(['ls', __dirname + '/Uploads/'], function(err, out, code) {
-  			  if (err instanceof Error)
-    		 	 throw err;		
-  		 	  //process.stdout.write(out);
-  		 	  var res = out.split('\n');
-  		 	  for (var i = 0; i < res.length - 1; i++ ) {
-  		 	  		var JSONObj = {"type" : "File Name", "name" : res[i] };
-  		 	  		//console.log(JSONObj);
-  		 	  		socket.emit('Music List', JSONObj);
-  		 	  		//process.stdout.write(res);
-  		 	  	}
-		});
+		if(!JSONObj) {      // older pages expect one 'Music List' per file
+			var all = catalog.list();
+			for (var i = 0; i < all.items.length; i++ ) {
+				socket.emit('Music List', {"type" : "File Name", "name" : all.items[i].file});
+			}
+			return;
+		}
+		var page = catalog.list(JSONObj);
+		page.type = "File List";
+		socket.emit('Music List Page', page);
   	}); 
 
+  	// {text, melody, key, metre, page, pageSize} -> 'Search Results', best matches first
+  	socket.on('Search Scores', function(JSONObj){
+		var results = search.search(JSONObj);
+		results.type = "Search Results";
+		socket.emit('Search Results', results);
+  	});
+
 	socket.on('Get Annotation', function(JSONObj) {
-		if(session != null) {
-			for (var t = 0; t < sockets.length; t++ ) {
-				if(JSONObj.type == "Rect") {
-					sockets[t].emit('Rectangle', JSONObj);
-				} else {
-					sockets[t].emit(JSONObj.type, JSONObj);
-				}
+		var room = sessions.roomOf(socket);
+		if(room) {
+			if(JSONObj.type == "Rect") {
+				sessions.broadcastAnnotation(room, 'Rectangle', JSONObj);
+			} else {
+				sessions.broadcastAnnotation(room, JSONObj.type, JSONObj);
 			}
 		} else {
-			console.log("Not in a session\n");
+			logger.debug("Get Annotation %s, not in a session", JSONObj.type);
 			if(JSONObj.type == "Rect") {
-				console.log("send a rect \n");
 				socket.emit('Rectangle', JSONObj);
 			} else {
-				console.log("send a " + JSONObj.type + "\n");
 				socket.emit(JSONObj.type, JSONObj);
 			}	
 		}
@@ -215,39 +411,24 @@ io.on('connection', function(socket){
 			
 	socket.on('Get Session List', function(JSONObj){
 		var tempCollection = null;
-		if(session != null) {
-			tempCollection = collection;
+		var room = sessions.roomOf(socket);
+		if(room) {
+			tempCollection = room.collection;
 		} else if(JSONObj.designation == "teacher"){
 			tempCollection = teacherCollection;
 		} else if(JSONObj.designation == "student"){
 			tempCollection = studentCollection;
 		}
-		console.log("tempCollection is " + tempCollection);
-		collectionDriver.findAll(tempCollection, function(err, success) {
-				if(err) { console.log('Error Retrieving'); }
-				else { 
-					for(var i = 0; i < success.length; i++) {
-						socket.emit('Annotation', success[i]);
-					}
-					socket.emit('Annotation', null);
-				}	
+		logger.debug("tempCollection is %s", tempCollection);
+		var options = {"snapshot" : JSONObj.snapshot, "compress" : JSONObj.compress};
+		annotationReplay.replay(tempCollection, socket, options, function(err, count) {
+				if(err) { logger.error('Error retrieving %s', tempCollection); }
   			});
   	});
   	
   	socket.on('Rectangle', function(JSONObj){
-  		collectionDriver.save(collection, JSONObj, function(err,success) {
-          if (err) { console.log('Error'); } 
-          else { console.log('Success'); } 
-     	});
-
-  		if(session) {
-  			for (var i = 0; i < sockets.length; i++ ) {
-  				if(sockets[i] == socket) continue;
-  				sockets[i].emit('Rectangle', JSONObj);
-  			}
-  		} else {
-  			socket.emit('Rectangle', JSONObj);
-  		}
+  		relayAnnotation(socket, 'Rectangle', JSONObj);
+
   		
 
 		/*collectionDriver.findAll(collection, function(err, success) {
@@ -264,19 +445,8 @@ io.on('connection', function(socket){
 	});
 	
 		socket.on('Highlight', function(JSONObj){
-  			collectionDriver.save(collection, JSONObj, function(err,success) {
-         		if (err) { console.log('Error'); } 
-          		else { console.log('Success'); } 
-     		});
-
-  			if(session) {
-  				for (var i = 0; i < sockets.length; i++ ) {
-  					if(sockets[i] == socket) continue;
-  					sockets[i].emit('Highlight', JSONObj);
-  				}
-  			} else {
-  				socket.emit('Highlight', JSONObj);
-  			}
+  			relayAnnotation(socket, 'Highlight', JSONObj);
+
 			/*collectionDriver.findAll(collection, function(err, success) {
 						if(err) { console.log('Error Retrieving'); }
 						else { console.log(success);
@@ -291,19 +461,8 @@ io.on('connection', function(socket){
   		});
 
   		socket.on('Text', function(JSONObj){
-  			collectionDriver.save(collection, JSONObj, function(err,success) {
-          		if (err) { console.log('Error'); } 
-          		else { console.log('Success'); } 
-     		});
-
-  			if(session) {
-  				for (var i = 0; i < sockets.length; i++ ) {
-  					if(sockets[i] == socket) continue;
-  					sockets[i].emit('Text', JSONObj);
-  				}
-  			} else {
-  				socket.emit('Text', JSONObj);
-  			}
+  			relayAnnotation(socket, 'Text', JSONObj);
+
 
 			/*collectionDriver.findAll(collection, function(err, success) {
 						if(err) { console.log('Error Retrieving'); }
@@ -319,14 +478,22 @@ io.on('connection', function(socket){
   		});
   		
   	socket.on('disconnect', function(){
-  		var i = sockets.indexOf(socket);
-  		var j = sessionSockets.indexOf(socket);
-  		sockets.splice(i, 1);
-  		sessionSockets.splice(j, 1);
-  		console.log('user disconnected');
+  		sessions.leave(socket);
+  		socketsConnected.dec();
+  		logger.debug('user disconnected');
   	});
 });
 
-http.listen(3000, function(){
-  console.log('listening on *:3000');
-});
+if (cluster.isWorker) {
+  // the master accepts the connections and passes each one on
+  process.on('message', function(msg, conn) {
+    if (msg != 'sticky-connection' || !conn) return;
+    http.emit('connection', conn);
+    conn.resume();
+  });
+} else {
+  var port = process.env.PORT || 3000;
+  http.listen(port, function(){
+    logger.info('listening on *:%s', port);
+  });
+}
@@ -0,0 +1,277 @@
+// Classroom load generator for index.js.
+//
+//   node loadtest.js [--teachers K] [--students N[,N2,...]] [--bursts B]
+//                    [--burst-size S] [--interval MS] [--file SCORE]
+//                    [--binary] [--cluster WORKERS] [--port PORT] [--url URL]
+//                    [--timeout MS]
+//
+// For every student count it starts index.js with --memory-db (unless --url
+// points at a running server), lets K teachers each open a session on SCORE
+// and spreads N students over those sessions, which they enter with 'Join
+// Session' and 'Get ABC'. Every client then sends B bursts of S
+// Rectangle/Highlight/Text events. It reports the latency from sending an
+// event to its receipt by the other members of the session, the time clients
+// wait for their ABC, the part of it conversions spent queued for a slot
+// (from the server's /metrics, so only for a server on this machine), and
+// the server's CPU and RSS.
+// --cluster runs the server as a cluster of that many workers (balanced per
+// connection); CPU and RSS then add up the master and its workers.
+// A round gives up, naming the clients still waiting and exiting with 1, when
+// not every client has its ABC after --timeout ms.
+var io = require('socket.io-client'),
+    fs = require('fs'),
+    http = require('http'),
+    spawn = require('child_process').spawn,
+    AnnotationCodec = require('./annotationCodec');
+
+var options = {
+  teachers: 1, students: '30', bursts: 5, burstSize: 20, interval: 200,
+  file: 'Saltarello.xml', binary: false, cluster: 0, port: 3100, url: null, timeout: 60000
+};
+
+function parseArgs(argv) {
+  for (var i = 0; i < argv.length; i++) {
+    var name = argv[i].replace(/^--/, '').replace(/-(\w)/g, function(m, c) { return c.toUpperCase(); });
+    if (!(name in options)) throw new Error('unknown option ' + argv[i]);
+    if (typeof options[name] == 'boolean') options[name] = true;
+    else if (typeof options[name] == 'number') options[name] = Number(argv[++i]);
+    else options[name] = argv[++i];
+  }
+}
+
+function percentile(sorted, p) {
+  if (!sorted.length) return NaN;
+  return sorted[Math.min(sorted.length - 1, Math.floor(p / 100 * sorted.length))];
+}
+
+// CPU seconds and RSS of a process and its children, from /proc (Linux only)
+function processStats(pid) {
+  try {
+    var fields = fs.readFileSync('/proc/' + pid + '/stat', 'utf8').split(') ')[1].split(' ');
+    var stats = {cpu: (Number(fields[11]) + Number(fields[12])) / 100, rss: Number(fields[21]) * 4096};
+  } catch (e) {
+    return null;
+  }
+  try {
+    var children = fs.readFileSync('/proc/' + pid + '/task/' + pid + '/children', 'utf8').trim().split(/\s+/);
+  } catch (e) {
+    children = [];
+  }
+  children.forEach(function(child) {
+    var more = child && processStats(child);
+    if (more) { stats.cpu += more.cpu; stats.rss += more.rss; }
+  });
+  return stats;
+}
+
+function startServer(callback) {
+  if (options.url) return callback(null, null);
+  var args = [__dirname + '/index.js', '--memory-db'];
+  if (options.cluster) args.push('--cluster', '--workers', String(options.cluster), '--balance', 'connection');
+  var server = spawn(process.execPath, args,
+                     {cwd: __dirname, env: Object.assign({}, process.env, {PORT: String(options.port)})});
+  server.stdout.on('data', function listening(data) {
+    if (String(data).indexOf('listening') == -1) return;
+    server.stdout.removeListener('data', listening);
+    server.stdout.resume();     // keep draining the server's console output
+    callback(null, server);
+  });
+  server.stderr.resume();
+  server.on('exit', function(code) {
+    if (code) console.error('server exited with code ' + code);
+  });
+}
+
+// conversion_queue_seconds of the interactive lane, added up over the server's
+// processes: {sum, count, buckets: {le: count}}, or null without /metrics
+function queueStats(url, callback) {
+  http.get(url + '/metrics', function(res) {
+    var text = '';
+    res.setEncoding('utf8');
+    res.on('data', function(chunk) { text += chunk; });
+    res.on('end', function() {
+      if (res.statusCode != 200) return callback(null);
+      var stats = {sum: 0, count: 0, buckets: {}};
+      text.split('\n').forEach(function(line) {
+        var m = /^conversion_queue_seconds_(bucket|sum|count)\{([^}]*)\} (\S+)$/.exec(line);
+        if (!m || m[2].indexOf('lane="interactive"') == -1) return;
+        if (m[1] != 'bucket') return stats[m[1]] += Number(m[3]);
+        var le = /le="([^"]*)"/.exec(m[2])[1];
+        stats.buckets[le] = (stats.buckets[le] || 0) + Number(m[3]);
+      });
+      callback(stats);
+    });
+  }).on('error', function() { callback(null); });
+}
+
+// conversions queued between two queueStats, their mean wait and the bucket
+// bound of their 99th percentile, in ms
+function queueSummary(before, after) {
+  if (!before || !after || after.count == before.count) return {count: 0, mean: NaN, p99: NaN};
+  var count = after.count - before.count;
+  var bounds = Object.keys(after.buckets).sort(function(a, b) { return Number(a) - Number(b); });
+  var p99 = Infinity;
+  for (var i = 0; i < bounds.length; i++) {
+    if (after.buckets[bounds[i]] - (before.buckets[bounds[i]] || 0) >= 0.99 * count) {
+      p99 = Number(bounds[i]) * 1000;
+      break;
+    }
+  }
+  return {count: count, mean: (after.sum - before.sum) / count * 1000, p99: p99};
+}
+
+// one client: a socket with its session, sequence numbers and decoder
+function Client(name, session, url) {
+  this.name = name;
+  this.session = session;
+  this.seq = 0;
+  this.decoder = new AnnotationCodec.Decoder();
+  this.socket = io.connect(url, {forceNew: true, transports: ['websocket']});
+}
+
+function runRound(students, callback) {
+  var url = options.url || 'http://localhost:' + options.port;
+  var sent = {};            // event id -> {at, pending receipts}
+  var latencies = [], abcWaits = [], lost = 0, received = 0;
+  var clients = [], ready = 0;
+
+  startServer(function(err, server) {
+    queueStats(url, function(queuedBefore) {
+      var before = server && processStats(server.pid);
+      var started = Date.now();
+
+      for (var k = 0; k < options.teachers; k++) {
+        clients.push(new Client('teacher' + k, 'load ' + k, url));
+      }
+      for (var n = 0; n < students; n++) {
+        clients.push(new Client('student' + n, 'load ' + (n % options.teachers), url));
+      }
+      var members = {};
+      clients.forEach(function(c) { members[c.session] = (members[c.session] || 0) + 1; });
+
+      clients.forEach(function(c) {
+        function receipt(obj) {
+          var id = obj && obj.id;
+          if (!id || !sent[id]) return;
+          received++;
+          latencies.push(Date.now() - sent[id].at);
+          if (--sent[id].pending == 0) delete sent[id];
+        }
+        ['Rectangle', 'Highlight', 'Text'].forEach(function(ev) { c.socket.on(ev, receipt); });
+        c.socket.on('Wire', function(msg) { if (msg.table) c.decoder.update(msg); });
+        c.socket.on('Packed', function(data) { receipt(c.decoder.decode(data).value); });
+        c.socket.on('ABC', function() {
+          if (c.ready) return;
+          c.ready = true;
+          abcWaits.push(Date.now() - c.askedAt);
+          c.socket.emit('Get Session List', {"designation" : "session", "snapshot" : true});
+          if (++ready == clients.length) {
+            clearTimeout(giveUp);
+            startBursts();
+          }
+        });
+        c.socket.on('ABC Error', function(msg) { c.error = msg.error; });
+        c.socket.on('disconnect', function() { c.disconnected = true; });
+      });
+
+      // a failed conversion or a lost client must not hang the run
+      var giveUp = setTimeout(function() {
+        var waiting = clients.filter(function(c) { return !c.ready; });
+        console.error('no ABC after ' + options.timeout + ' ms for ' + waiting.length + ' of ' + clients.length + ' clients: ' +
+                      waiting.map(function(c) {
+                        return c.name + (c.disconnected ? ' (disconnected)' : c.error ? ' (' + c.error + ')' : '');
+                      }).join(', '));
+        clients.forEach(function(c) { c.socket.disconnect(); });
+        if (server) server.kill();
+        process.exit(1);
+      }, options.timeout);
+
+      // teachers open their sessions on the score first, then the students join them
+      clients.forEach(function(c) {
+        if (options.binary) c.socket.emit('Wire', {"formats" : [AnnotationCodec.FORMAT, "json"]});
+      });
+      clients.slice(0, options.teachers).forEach(function(c) {
+        c.socket.emit('Session', {"type" : "Session", "name" : c.session});
+        c.askedAt = Date.now();
+        c.socket.emit('Get ABC', {"session" : c.session, "file" : options.file});
+      });
+      setTimeout(function() {
+        clients.slice(options.teachers).forEach(function(c) {
+          c.socket.emit('Join Session', {"name" : c.session});
+          c.askedAt = Date.now();
+          c.socket.emit('Get ABC', {"session" : c.session});
+        });
+      }, 200);
+
+      function send(c) {
+        var id = c.name + ':' + (c.seq++);
+        var kind = c.seq % 3, obj;
+        var author = c.name.indexOf('teacher') == 0 ? 'teacher' : 'student';
+        if (kind == 0) obj = {"type" : "Rect", "initX" : 10, "initY" : 20, "width" : 30, "height" : 40};
+        else if (kind == 1) obj = {"type" : "Highlight", "initX" : 10, "initY" : 20, "finalX" : 90};
+        else obj = {"type" : "Text", "initX" : 10, "initY" : 20, "content" : ['l', 'o', 'a', 'd']};
+        obj.author = author;
+        obj.session = c.session;
+        obj.id = id;
+        sent[id] = {at: Date.now(), pending: members[c.session] - 1};
+        if (sent[id].pending == 0) delete sent[id];
+        c.socket.emit(['Rectangle', 'Highlight', 'Text'][kind], obj);
+      }
+
+      function startBursts() {
+        var burst = 0;
+        var timer = setInterval(function() {
+          clients.forEach(function(c) {
+            for (var i = 0; i < options.burstSize; i++) send(c);
+          });
+          if (++burst == options.bursts) {
+            clearInterval(timer);
+            setTimeout(finish, 2000);   // grace period for the last receipts
+          }
+        }, options.interval);
+      }
+
+      function finish() {
+        for (var id in sent) lost += sent[id].pending;
+        var after = server && processStats(server.pid);
+        var seconds = (Date.now() - started) / 1000;
+        clients.forEach(function(c) { c.socket.disconnect(); });
+        queueStats(url, function(queuedAfter) {
+          if (server) server.kill();
+          latencies.sort(function(a, b) { return a - b; });
+          abcWaits.sort(function(a, b) { return a - b; });
+          var queued = queueSummary(queuedBefore, queuedAfter);
+          callback({
+            clients: clients.length, received: received, lost: lost,
+            p50: percentile(latencies, 50), p99: percentile(latencies, 99),
+            abc50: percentile(abcWaits, 50), abc99: percentile(abcWaits, 99),
+            queued: queued.count, queueMean: queued.mean, queue99: queued.p99,
+            cpu: before && after ? (after.cpu - before.cpu) / seconds * 100 : NaN,
+            rss: after ? after.rss / (1024 * 1024) : NaN
+          });
+        });
+      }
+    });
+  });
+}
+
+function row(cols) {
+  return cols.map(function(c) { return String(c); }).map(function(c) {
+    return '          '.slice(c.length) + c;
+  }).join(' ');
+}
+
+if (require.main == module) {
+  parseArgs(process.argv.slice(2));
+  var counts = String(options.students).split(',').map(Number);
+  console.log(row(['clients', 'received', 'lost', 'p50 ms', 'p99 ms', 'abc50 ms', 'abc99 ms',
+                   'queued', 'queue ms', 'queue99 ms', 'cpu %', 'rss MB']));
+  (function next(i) {
+    if (i == counts.length) return process.exit(0);
+    runRound(counts[i], function(r) {
+      console.log(row([r.clients, r.received, r.lost, r.p50, r.p99, r.abc50, r.abc99,
+                       r.queued, r.queueMean.toFixed(1), r.queue99, r.cpu.toFixed(0), r.rss.toFixed(1)]));
+      setTimeout(function() { next(i + 1); }, 500);
+    });
+  })(0);
+}
@@ -0,0 +1,53 @@
+var fs = require('fs'),
+    util = require('util');
+
+// Leveled logger. Lines below the level are dropped before they are
+// formatted, so debug calls cost next to nothing on the hot paths where
+// they are off by default. The others are collected and written in one
+// chunk per tick through an fs stream, which unlike process.stdout on a
+// pipe does not block the event loop.
+var LEVELS = {error: 0, warn: 1, info: 2, debug: 3};
+
+var Logger = function(level, stream) {
+  this.level = LEVELS.info;
+  this.setLevel(level);
+  this.stream = stream || null;   // opened on the first line: stdout
+  this.lines = [];
+  this.scheduled = false;
+};
+
+Logger.prototype.setLevel = function(level) {
+  if (level in LEVELS) this.level = LEVELS[level];
+};
+
+Logger.prototype.enabled = function(level) {
+  return LEVELS[level] <= this.level;
+};
+
+Logger.prototype.log = function(level, args) {
+  if (LEVELS[level] > this.level) return;
+  this.lines.push(new Date().toISOString() + ' ' + level + ' ' + util.format.apply(util, args) + '\n');
+  if (this.scheduled) return;
+  this.scheduled = true;
+  var self = this;
+  setImmediate(function() { self.flush(); });
+};
+
+Logger.prototype.error = function() { this.log('error', arguments); };
+Logger.prototype.warn = function() { this.log('warn', arguments); };
+Logger.prototype.info = function() { this.log('info', arguments); };
+Logger.prototype.debug = function() { this.log('debug', arguments); };
+
+// write out the collected lines; callback() once they are written
+Logger.prototype.flush = function(callback) {
+  this.scheduled = false;
+  if (!this.lines.length) return callback && callback();
+  if (!this.stream) this.stream = fs.createWriteStream(null, {fd: 1});
+  var chunk = this.lines.join('');
+  this.lines = [];
+  this.stream.write(chunk, callback);
+};
+
+exports.Logger = Logger;
+exports.LEVELS = LEVELS;
+exports.logger = new Logger(process.env.LOG_LEVEL);   // shared by the server modules
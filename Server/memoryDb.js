@@ -0,0 +1,80 @@
+// In-memory stand-in for the parts of the MongoDB Db API that
+// CollectionDriver uses, so the server can run without a mongod
+// (start it with --memory-db).
+
+var nextId = 0;
+
+// 24 hex digit ids, like ObjectID.toString()
+function newId() {
+  var hex = (Date.now().toString(16) + (nextId++).toString(16));
+  while (hex.length < 24) hex = '0' + hex;
+  return hex.slice(-24);
+}
+
+function matches(doc, query) {
+  for (var key in query) {
+    if (String(doc[key]) != String(query[key])) return false;
+  }
+  return true;
+}
+
+var MemoryCollection = function(name) {
+  this.name = name;
+  this.docs = [];
+};
+
+MemoryCollection.prototype.insert = function(docs, callback) {
+  var list = Array.isArray(docs) ? docs : [docs];
+  for (var i = 0; i < list.length; i++) {
+    if (list[i]._id == null) list[i]._id = newId();
+    this.docs.push(list[i]);
+  }
+  if (callback) process.nextTick(function() { callback(null, docs); });
+};
+
+MemoryCollection.prototype.find = function(query) {
+  var docs = this.docs;
+  return {
+    toArray: function(callback) {
+      var results = docs.filter(function(doc) { return matches(doc, query || {}); });
+      process.nextTick(function() { callback(null, results); });
+    }
+  };
+};
+
+MemoryCollection.prototype.findOne = function(query, callback) {
+  var found = null;
+  for (var i = 0; i < this.docs.length && !found; i++) {
+    if (matches(this.docs[i], query)) found = this.docs[i];
+  }
+  process.nextTick(function() { callback(null, found); });
+};
+
+MemoryCollection.prototype.save = function(doc, callback) {
+  for (var i = 0; i < this.docs.length; i++) {
+    if (doc._id != null && String(this.docs[i]._id) == String(doc._id)) {
+      this.docs[i] = doc;
+      return process.nextTick(function() { callback(null, doc); });
+    }
+  }
+  this.insert(doc, callback);
+};
+
+MemoryCollection.prototype.remove = function(query, callback) {
+  var before = this.docs.length;
+  this.docs = this.docs.filter(function(doc) { return !matches(doc, query); });
+  var removed = before - this.docs.length;
+  process.nextTick(function() { callback(null, removed); });
+};
+
+var MemoryDb = function() {
+  this.collections = {};
+};
+
+MemoryDb.prototype.collection = function(collectionName, callback) {
+  if (!this.collections[collectionName]) this.collections[collectionName] = new MemoryCollection(collectionName);
+  var the_collection = this.collections[collectionName];
+  process.nextTick(function() { callback(null, the_collection); });
+};
+
+exports.MemoryDb = MemoryDb;
@@ -0,0 +1,221 @@
+// Counters, gauges and histograms of the server, rendered in the Prometheus
+// text format for the local /metrics endpoint.
+//
+// Every series is identified by its labels, e.g. {event: 'Rectangle'}.
+// Histograms count observations into fixed buckets; latencies are observed
+// in seconds (see since), sizes in bytes.
+//
+// In cluster mode every process keeps its own series. The worker that is
+// asked for /metrics gets them from the master (collect), which gathers
+// its own and those of all workers and labels each with its process.
+var SECONDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30];
+var BYTES = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576];
+
+var Metrics = function() {
+  this.families = {};   // metric name -> {name, type, help, buckets, series: {label key -> series}}
+  this.port = null;     // IPC channel to the master, for collect
+  this.pending = {};    // request id -> callback
+  this.nextId = 1;
+};
+
+function labelKey(labels) {
+  if (!labels) return '';
+  return Object.keys(labels).sort().map(function(name) { return name + '=' + labels[name]; }).join(',');
+}
+
+Metrics.prototype.family = function(name, type, help, buckets) {
+  if (!this.families[name]) this.families[name] = {name: name, type: type, help: help, buckets: buckets, series: {}};
+  return new Metric(this.families[name]);
+};
+
+Metrics.prototype.counter = function(name, help) {
+  return this.family(name, 'counter', help);
+};
+
+// value: an optional function read whenever the metrics are rendered
+Metrics.prototype.gauge = function(name, help, value) {
+  var metric = this.family(name, 'gauge', help);
+  if (value) metric.family.read = value;
+  return metric;
+};
+
+Metrics.prototype.histogram = function(name, help, buckets) {
+  return this.family(name, 'histogram', help, buckets || SECONDS);
+};
+
+var Metric = function(family) {
+  this.family = family;
+};
+
+Metric.prototype.series = function(labels) {
+  var key = labelKey(labels);
+  var series = this.family.series[key];
+  if (!series) {
+    series = this.family.series[key] = {labels: labels || {}, value: 0, sum: 0, count: 0};
+    if (this.family.buckets) series.counts = this.family.buckets.map(function() { return 0; });
+  }
+  return series;
+};
+
+Metric.prototype.inc = function(labels, n) {
+  this.series(labels).value += n == null ? 1 : n;
+};
+
+Metric.prototype.dec = function(labels, n) {
+  this.series(labels).value -= n == null ? 1 : n;
+};
+
+Metric.prototype.set = function(labels, value) {
+  this.series(labels).value = value;
+};
+
+Metric.prototype.observe = function(labels, value) {
+  var series = this.series(labels), buckets = this.family.buckets;
+  series.sum += value;
+  series.count++;
+  for (var i = 0; i < buckets.length; i++) {
+    if (value <= buckets[i]) { series.counts[i]++; break; }
+  }
+};
+
+// seconds since a process.hrtime() start
+function since(start) {
+  var d = process.hrtime(start);
+  return d[0] + d[1] / 1e9;
+}
+
+// the current values, as plain data that can cross the IPC channel
+Metrics.prototype.snapshot = function() {
+  var families = [];
+  for (var name in this.families) {
+    var family = this.families[name];
+    if (family.read) new Metric(family).set(null, family.read());
+    var series = [];
+    for (var key in family.series) series.push(family.series[key]);
+    families.push({name: name, type: family.type, help: family.help, buckets: family.buckets, series: series});
+  }
+  return families;
+};
+
+function formatLabels(labels, extra) {
+  var pairs = [];
+  [labels, extra || {}].forEach(function(set) {
+    for (var name in set) pairs.push(name + '="' + String(set[name]).replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n') + '"');
+  });
+  return pairs.length ? '{' + pairs.join(',') + '}' : '';
+}
+
+// [{labels, families}] -> Prometheus text, the families of every source merged by name
+function render(sources) {
+  var byName = {}, names = [];
+  sources.forEach(function(source) {
+    source.families.forEach(function(family) {
+      if (!byName[family.name]) {
+        byName[family.name] = {family: family, lines: []};
+        names.push(family.name);
+      }
+      var lines = byName[family.name].lines;
+      family.series.forEach(function(series) {
+        var labels = series.labels;
+        if (family.type != 'histogram') {
+          lines.push(family.name + formatLabels(labels, source.labels) + ' ' + series.value);
+          return;
+        }
+        var cumulative = 0;
+        for (var i = 0; i < family.buckets.length; i++) {
+          cumulative += series.counts[i];
+          lines.push(family.name + '_bucket' + formatLabels(labels, merge(source.labels, {le: family.buckets[i]})) + ' ' + cumulative);
+        }
+        lines.push(family.name + '_bucket' + formatLabels(labels, merge(source.labels, {le: '+Inf'})) + ' ' + series.count);
+        lines.push(family.name + '_sum' + formatLabels(labels, source.labels) + ' ' + series.sum);
+        lines.push(family.name + '_count' + formatLabels(labels, source.labels) + ' ' + series.count);
+      });
+    });
+  });
+  return names.map(function(name) {
+    var family = byName[name].family;
+    return '# HELP ' + name + ' ' + family.help + '\n# TYPE ' + name + ' ' + family.type + '\n' +
+           byName[name].lines.map(function(line) { return line + '\n'; }).join('');
+  }).join('');
+}
+
+function merge(a, b) {
+  var c = {};
+  for (var name in a || {}) c[name] = a[name];
+  for (var name in b) c[name] = b[name];
+  return c;
+}
+
+Metrics.prototype.render = function() {
+  return render([{labels: null, families: this.snapshot()}]);
+};
+
+// Worker side: answer the master's snapshot requests over port (process).
+Metrics.prototype.attach = function(port) {
+  var self = this;
+  this.port = port;
+  port.on('message', function(msg) {
+    if (!msg || !msg.metrics) return;
+    if (msg.metrics == 'snapshot') {
+      port.send({metrics: 'snapshot', id: msg.id, families: self.snapshot()});
+    } else if (msg.metrics == 'collected') {
+      var callback = self.pending[msg.id];
+      delete self.pending[msg.id];
+      if (callback) callback(null, msg.text);
+    }
+  });
+};
+
+// callback(err, text) with the metrics of this process, or of the whole cluster
+Metrics.prototype.collect = function(callback) {
+  if (!this.port) return callback(null, this.render());
+  var id = this.nextId++;
+  this.pending[id] = callback;
+  this.port.send({metrics: 'collect', id: id});
+};
+
+// Master side: gather the metrics of the master and all workers when a
+// worker collects. workers is the master's live list of cluster workers.
+Metrics.prototype.serve = function(worker, workers) {
+  var self = this;
+  worker.on('message', function(msg) {
+    if (!msg || !msg.metrics) return;
+    if (msg.metrics == 'collect') {
+      self.gather(workers, function(text) {
+        if (worker.isConnected()) worker.send({metrics: 'collected', id: msg.id, text: text});
+      });
+    } else if (msg.metrics == 'snapshot') {
+      var callback = self.pending[msg.id];
+      delete self.pending[msg.id];
+      if (callback) callback(msg.families);
+    }
+  });
+};
+
+Metrics.prototype.gather = function(workers, callback) {
+  var sources = [{labels: {process: 'master'}, families: this.snapshot()}];
+  var waiting = 0, finished = false, self = this;
+  function finish() {
+    if (finished) return;
+    finished = true;
+    callback(render(sources));
+  }
+  workers.forEach(function(worker, index) {
+    if (!worker.isConnected()) return;
+    var id = self.nextId++;
+    waiting++;
+    self.pending[id] = function(families) {
+      sources.push({labels: {process: 'worker' + index}, families: families});
+      if (--waiting == 0) finish();
+    };
+    worker.send({metrics: 'snapshot', id: id});
+  });
+  if (waiting == 0) return finish();
+  setTimeout(finish, 1000);       // a busy or dying worker does not hold up the answer
+};
+
+exports.Metrics = Metrics;
+exports.SECONDS = SECONDS;
+exports.BYTES = BYTES;
+exports.since = since;
+exports.metrics = new Metrics();    // shared by the server modules
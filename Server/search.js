@@ -0,0 +1,325 @@
+var fs = require('fs'),
+    os = require('os'),
+    path = require('path'),
+    logger = require('./logger').logger;
+
+// Search index over the score library, by text (title, movement, composer,
+// lyricist, part names, file name) and by melody. The terms come from
+// xml2abc.py -x: while a score is converted (the converter's 'terms'), and
+// for scores that were never converted, from a background pass (backfill).
+//
+// Melodies are indexed as n-grams of the intervals of every voice, so a
+// fragment is found in any key. Text matches whole words and word
+// prefixes; title words count for more than composers, which count for
+// more than part names.
+//
+// Both indexes map a term to its postings: a flat array of document number
+// and weight pairs, in increasing document order. On disk every pair is one
+// number: the difference to the previous document number times 16 plus the
+// weight, which is capped at 15 there. A score that is converted again gets
+// a new document; the old one is skipped until the next save renumbers the
+// documents.
+var GRAM = 3;             // intervals per melodic n-gram, as in xml2abc.py
+var WEIGHTS = {title: 3, movement: 3, composer: 2, lyricist: 2, parts: 1};
+
+var SearchIndex = function(exec, uploadDir, indexFile) {
+  this.exec = exec;
+  this.uploadDir = uploadDir;
+  this.indexFile = indexFile;
+  this.docs = [];       // document number -> {file, title, composer, key, metre}, null once replaced
+  this.byFile = Object.create(null);  // file name -> document number
+  this.text = Object.create(null);    // word -> postings
+  this.melody = Object.create(null);  // interval n-gram -> postings
+  this.words = null;    // sorted words for prefix matches, rebuilt after a change
+  this.live = 0;        // documents that were not replaced
+  this.early = [];      // [file, terms] added before the stored index was read
+  this.loaded = false;
+  this.batchSize = 20;  // scores per xml2abc process when backfilling
+  this.saveTimer = null;
+  this.readOnly = false;  // another process writes indexFile
+};
+
+// lower case words without accents
+function tokenize(text) {
+  return String(text || '').toLowerCase().normalize('NFD').replace(/[\u0300-\u036f]/g, '')
+    .split(/[^a-z0-9\u00c0-\uffff]+/).filter(function(word) { return word; });
+}
+
+function gramsOf(pitches) {
+  var ivs = [], grams = {};
+  for (var i = 1; i < pitches.length; i++) ivs.push(Math.max(-24, Math.min(24, pitches[i] - pitches[i - 1])));
+  for (var i = 0; i + GRAM <= ivs.length; i++) {
+    grams[ivs.slice(i, i + GRAM).map(function(x) { return (x >= 0 ? '+' : '') + x; }).join(' ')] = true;
+  }
+  return Object.keys(grams);
+}
+
+// midi pitches of a fragment in ABC notes, e.g. "GAB c2 d/e/ ^f": accidentals
+// apply to their own note only, lengths, bars and rests are ignored
+function parseMelody(text) {
+  var steps = {c: 0, d: 2, e: 4, f: 5, g: 7, a: 9, b: 11};
+  var pitches = [], note = /([\^_=]*)([A-Ga-g])([,']*)/g, m;
+  while ((m = note.exec(String(text || '')))) {
+    var p = (m[2] == m[2].toLowerCase() ? 72 : 60) + steps[m[2].toLowerCase()];
+    for (var i = 0; i < m[1].length; i++) p += m[1][i] == '^' ? 1 : m[1][i] == '_' ? -1 : 0;
+    for (var i = 0; i < m[3].length; i++) p += m[3][i] == "'" ? 12 : -12;
+    pitches.push(p);
+  }
+  return pitches;
+}
+
+function post(index, term, doc, weight) {
+  (index[term] || (index[term] = [])).push(doc, weight);
+}
+
+// read the stored index; scores added meanwhile are indexed after it
+SearchIndex.prototype.load = function(callback) {
+  var self = this;
+  fs.readFile(this.indexFile, 'utf8', function(err, data) {
+    if (!err) {
+      try { self.restore(JSON.parse(data)); }
+      catch (e) { self.restore({}); }
+    }
+    self.loaded = true;
+    self.early.forEach(function(item) { self.add(item[0], item[1]); });
+    self.early = [];
+    if (callback) callback(null);
+  });
+};
+
+SearchIndex.prototype.restore = function(stored) {
+  if (stored.version != 1) stored = {docs: [], text: {}, melody: {}};
+  this.docs = stored.docs;
+  this.byFile = Object.create(null);
+  for (var i = 0; i < this.docs.length; i++) this.byFile[this.docs[i].file] = i;
+  this.live = this.docs.length;
+  this.text = decode(stored.text);
+  this.melody = decode(stored.melody);
+  this.words = null;
+};
+
+function encode(index) {
+  var stored = {};
+  for (var term in index) {
+    var postings = index[term], list = [], prev = 0;
+    for (var i = 0; i < postings.length; i += 2) {
+      list.push((postings[i] - prev) * 16 + Math.min(postings[i + 1], 15));
+      prev = postings[i];
+    }
+    stored[term] = list;
+  }
+  return stored;
+}
+
+function decode(stored) {
+  var index = Object.create(null);
+  for (var term in stored) {
+    var list = stored[term], postings = [], doc = 0;
+    for (var i = 0; i < list.length; i++) {
+      doc += Math.floor(list[i] / 16);
+      postings.push(doc, list[i] % 16);
+    }
+    index[term] = postings;
+  }
+  return index;
+}
+
+// index the terms of a score, replacing those of an earlier version
+SearchIndex.prototype.add = function(file, terms) {
+  if (!this.loaded) return this.early.push([file, terms]);
+  this.remove(file);
+  var doc = this.docs.length;
+  this.docs.push({file: file, title: terms.title || terms.movement || '', composer: (terms.composer || []).join(', '),
+                  key: terms.key || '', metre: terms.metre || ''});
+  this.byFile[file] = doc;
+  this.live++;
+  var words = {};
+  tokenize(file.replace(/\.[^.]*$/, '')).forEach(function(word) { words[word] = 1; });
+  for (var field in WEIGHTS) {
+    [].concat(terms[field] || []).forEach(function(value) {
+      tokenize(value).forEach(function(word) { words[word] = Math.max(words[word] || 0, WEIGHTS[field]); });
+    });
+  }
+  for (var word in words) post(this.text, word, doc, words[word]);
+  for (var gram in terms.melody || {}) post(this.melody, gram, doc, terms.melody[gram]);
+  this.words = null;
+  this.save();
+};
+
+SearchIndex.prototype.remove = function(file) {
+  var doc = this.byFile[file];
+  if (doc == null) return;
+  this.docs[doc] = null;
+  delete this.byFile[file];
+  this.live--;
+  if (this.docs.length - this.live > Math.max(100, this.live / 4)) this.compact();
+};
+
+// drop the replaced documents and number the others again
+SearchIndex.prototype.compact = function() {
+  var renumber = [], docs = [];
+  for (var i = 0; i < this.docs.length; i++) {
+    if (!this.docs[i]) continue;
+    renumber[i] = docs.length;
+    docs.push(this.docs[i]);
+  }
+  [this.text, this.melody].forEach(function(index) {
+    for (var term in index) {
+      var postings = index[term], kept = [];
+      for (var i = 0; i < postings.length; i += 2) {
+        if (renumber[postings[i]] != null) kept.push(renumber[postings[i]], postings[i + 1]);
+      }
+      if (kept.length) index[term] = kept;
+      else delete index[term];
+    }
+  });
+  this.docs = docs;
+  for (var i = 0; i < docs.length; i++) this.byFile[docs[i].file] = i;
+  this.words = null;
+};
+
+// write the index at most once a second
+SearchIndex.prototype.save = function() {
+  if (this.readOnly || this.saveTimer) return;
+  var self = this;
+  this.saveTimer = setTimeout(function() {
+    self.saveTimer = null;
+    if (self.live < self.docs.length) self.compact();
+    var stored = {version: 1, docs: self.docs, text: encode(self.text), melody: encode(self.melody)};
+    fs.writeFile(self.indexFile, JSON.stringify(stored), function(err) {
+      if (err) logger.error('Error saving search index: %s', err.message);
+    });
+  }, 1000);
+};
+
+// Index the scores that are not in the index yet, a batch per xml2abc
+// process, one batch at a time. callback(file, terms) follows every score.
+SearchIndex.prototype.backfill = function(files, callback) {
+  var self = this;
+  var todo = files.filter(function(file) { return /\.(xml|mxl)$/i.test(file) && self.byFile[file] == null; });
+  var termsFile = path.join(os.tmpdir(), 'xml2abc-terms-' + process.pid + '-backfill.json');
+  (function next() {
+    var batch = todo.splice(0, self.batchSize);
+    if (!batch.length) return;
+    var args = ['python', 'xml2abc.py', '-x', termsFile];
+    for (var i = 0; i < batch.length; i++) args.push(self.uploadDir + batch[i]);
+    self.exec(args, function(err, out, code) {      // the ABC on stdout is not needed
+      fs.readFile(termsFile, 'utf8', function(err, data) {
+        fs.unlink(termsFile, function() {});
+        String(data || '').split('\n').forEach(function(line) {
+          if (!line) return;
+          try { var terms = JSON.parse(line); }
+          catch (e) { return; }
+          if (self.byFile[terms.file] != null) return;    // converted meanwhile
+          self.add(terms.file, terms);
+          if (callback) callback(terms.file, terms);
+        });
+        next();
+      });
+    });
+  })();
+};
+
+// the postings of every word starting with prefix: [[word, postings]]
+SearchIndex.prototype.prefixed = function(prefix) {
+  if (!this.words) this.words = Object.keys(this.text).sort();
+  var words = this.words, lo = 0, hi = words.length, found = [];
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (words[mid] < prefix) lo = mid + 1;
+    else hi = mid;
+  }
+  for (var i = lo; i < words.length && words[i].indexOf(prefix) == 0; i++) found.push([words[i], this.text[words[i]]]);
+  return found;
+};
+
+SearchIndex.prototype.idf = function(postings) {
+  return Math.log(1 + this.live / (postings.length / 2));
+};
+
+// document number -> score of the documents matching one query word
+SearchIndex.prototype.matchWord = function(word) {
+  var hits = {};
+  var self = this;
+  this.prefixed(word).forEach(function(match) {
+    var postings = match[1];
+    var idf = self.idf(postings) * (match[0] == word ? 1 : 0.5);    // whole words first
+    for (var i = 0; i < postings.length; i += 2) {
+      if (!self.docs[postings[i]]) continue;
+      var score = postings[i + 1] * idf;
+      if (!(hits[postings[i]] >= score)) hits[postings[i]] = score;
+    }
+  });
+  return hits;
+};
+
+// document number -> score of the documents sharing at least half the
+// n-grams of the fragment
+SearchIndex.prototype.matchMelody = function(grams) {
+  var scores = {}, counts = {}, hits = {};
+  for (var g = 0; g < grams.length; g++) {
+    var postings = this.melody[grams[g]];
+    if (!postings) continue;
+    var idf = this.idf(postings);
+    for (var i = 0; i < postings.length; i += 2) {
+      if (!this.docs[postings[i]]) continue;
+      scores[postings[i]] = (scores[postings[i]] || 0) + idf;
+      counts[postings[i]] = (counts[postings[i]] || 0) + 1;
+    }
+  }
+  var needed = Math.ceil(grams.length / 2);
+  for (var doc in counts) {
+    if (counts[doc] >= needed) hits[doc] = scores[doc];
+  }
+  return hits;
+};
+
+function intersect(scores, hits) {
+  if (!scores) return hits;
+  var both = {};
+  for (var doc in scores) {
+    if (doc in hits) both[doc] = scores[doc] + hits[doc];
+  }
+  return both;
+}
+
+// {text, melody, key, metre, page, pageSize} -> {total, page, pageSize, items, ms[, error]}
+// with the best matches first; every query field is optional
+SearchIndex.prototype.search = function(query) {
+  query = query || {};
+  var started = Date.now();
+  var scores = null, error = null;
+  var words = tokenize(query.text);
+  for (var i = 0; i < words.length; i++) scores = intersect(scores, this.matchWord(words[i]));
+  if (query.melody) {
+    var grams = gramsOf(parseMelody(query.melody));
+    if (grams.length) scores = intersect(scores, this.matchMelody(grams));
+    else {
+      error = 'a melody needs at least ' + (GRAM + 1) + ' notes';
+      scores = scores || {};
+    }
+  }
+  if (!scores) {
+    scores = {};
+    for (var doc = 0; doc < this.docs.length; doc++) {
+      if (this.docs[doc]) scores[doc] = 0;
+    }
+  }
+  var key = String(query.key || '').toLowerCase(), metre = String(query.metre || '');
+  var items = [];
+  for (var doc in scores) {
+    var d = this.docs[doc];
+    if ((key && d.key.toLowerCase() != key) || (metre && d.metre != metre)) continue;
+    items.push({file: d.file, title: d.title, composer: d.composer, key: d.key, metre: d.metre,
+                score: Math.round(scores[doc] * 100) / 100});
+  }
+  items.sort(function(a, b) { return b.score - a.score || (a.file < b.file ? -1 : a.file > b.file ? 1 : 0); });
+  var page = Math.max(0, parseInt(query.page, 10) || 0);
+  var pageSize = Math.max(1, Math.min(200, parseInt(query.pageSize, 10) || 20));
+  var result = {total: items.length, page: page, pageSize: pageSize,
+                items: items.slice(page * pageSize, (page + 1) * pageSize), ms: Date.now() - started};
+  if (error) result.error = error;
+  return result;
+};
+
+exports.SearchIndex = SearchIndex;
@@ -0,0 +1,317 @@
+// Sessions (rooms) hosted by this server. Every session owns its score, the
+// converted ABC and its member sockets; broadcasts go through socket.io rooms
+// so they only reach the members of that session.
+//
+// In cluster mode the members of a session can be spread over several
+// worker processes. A broker (see broker.js) then keeps the list of sessions
+// and their scores, and carries the session's broadcasts to the other
+// workers. A worker only follows the channel of a session while some of its
+// sockets are members. The session records themselves (name and score) are
+// mirrored to every worker rather than sharded by name: they are a few bytes
+// each, and any worker may be handed a member of any session.
+//
+// A session is closed once it has had no members, in any worker, for
+// closeAfter ms: the teacher's pages join it one after the other, so an
+// empty session may only be between two of them. Every worker keeps a
+// 'members:<worker>:<name>' key in the broker while it has members.
+//
+// Emits 'empty' (room) when the last member of a session in this process
+// leaves it.
+var EventEmitter = require('events').EventEmitter,
+    AnnotationCodec = require('./annotationCodec'),
+    Metrics = require('./metrics'),
+    metrics = Metrics.metrics,
+    since = Metrics.since;
+
+var fanoutTime = metrics.histogram('broadcast_seconds', 'Time to hand a broadcast to the members of a session in this process');
+var fanoutSize = metrics.histogram('broadcast_bytes', 'Size of a packed broadcast message', Metrics.BYTES);
+
+// metric label of an event; the rest come from clients and are lumped together
+var LABELS = {'Rectangle' : true, 'Highlight' : true, 'Text' : true};
+function label(event) {
+  return LABELS.hasOwnProperty(event) ? event : 'other';
+}
+
+var LOBBY = 'lobby';      // sockets waiting on the student page for new sessions
+
+var Room = function(name) {
+  this.name = name;
+  this.channel = 'session:' + name;   // socket.io room, kept apart from socket ids
+  this.file = null;       // MusicXML file in Uploads/
+  this.collection = null; // annotation collection of that file
+  this.abc = null;        // converted ABC of the file
+  this.generation = 0;    // counts the changes of the score, so late conversions cannot set abc
+  this.members = {};      // socket id -> socket
+  this.size = 0;
+  this.binary = 0;        // members that asked for packed annotation events
+  this.encoder = new AnnotationCodec.Encoder();
+  this.relay = null;      // handler of the session's broker channel, while followed
+  this.closing = null;    // timer closing the session if nobody joins it
+};
+
+// the members using one wire format, JSON unless negotiated otherwise
+Room.prototype.formatChannel = function(socket) {
+  return this.channel + (socket.wireFormat == AnnotationCodec.FORMAT ? ':bin' : ':json');
+};
+
+Room.prototype.setFile = function(file) {
+  if (!file || this.file == file) return;
+  this.file = file;
+  this.collection = file.split('.')[0];
+  this.abc = null;
+  this.generation++;
+};
+
+var SessionManager = function(io, broker, options) {
+  EventEmitter.call(this);
+  options = options || {};
+  this.io = io;
+  this.broker = broker || null;
+  this.id = options.id != null ? options.id : 0;          // worker index, in a cluster
+  this.closeAfter = options.closeAfter || 60000;
+  this.rooms = {};        // session name -> Room
+  this.socketRooms = {};  // socket id -> Room it is a member of
+  if (!this.broker) return;
+  var self = this;
+  this.broker.keys('members:', function(err, keys) {     // left by this worker before a restart
+    if (err) return;
+    keys.forEach(function(key) {
+      if (memberKey(key).id == String(self.id)) self.broker.remove(key);
+    });
+  });
+  this.broker.subscribe('sessions', function(record) { self.mirror(record); });
+  this.broker.subscribe(LOBBY, function(msg) { self.io.to(LOBBY).emit(msg.event, msg.data); });
+  this.broker.keys('session:', function(err, keys) {     // sessions opened before this worker started
+    if (err) return;
+    keys.forEach(function(key) {
+      self.broker.get(key, function(err, record) {
+        if (!err && record) self.mirror(record);
+      });
+    });
+  });
+};
+
+SessionManager.prototype.__proto__ = EventEmitter.prototype;
+
+// {id, name} of a 'members:<worker>:<name>' key
+function memberKey(key) {
+  var colon = key.indexOf(':', 8);
+  return {id: key.slice(8, colon), name: key.slice(colon + 1)};
+}
+
+SessionManager.prototype.create = function(name) {
+  if (!this.rooms[name]) {
+    this.rooms[name] = new Room(name);
+    this.share(this.rooms[name]);
+    this.closeIfIdle(this.rooms[name]);   // nobody may ever join it
+  }
+  return this.rooms[name];
+};
+
+// open the score of a session, in every worker
+SessionManager.prototype.setFile = function(room, file) {
+  if (!file || room.file == file) return;
+  room.setFile(file);
+  this.share(room);
+};
+
+// store a session's record and tell the other workers about it
+SessionManager.prototype.share = function(room) {
+  if (!this.broker) return;
+  var record = {name: room.name, file: room.file};
+  this.broker.set('session:' + room.name, record);
+  this.broker.publish('sessions', record);
+};
+
+// a session created, changed or closed by another worker
+SessionManager.prototype.mirror = function(record) {
+  if (record.closed) {
+    if (this.rooms[record.name]) this.remove(this.rooms[record.name]);
+    return;
+  }
+  var room = this.rooms[record.name] || (this.rooms[record.name] = new Room(record.name));
+  room.setFile(record.file);
+};
+
+SessionManager.prototype.get = function(name) {
+  return this.rooms[name] || null;
+};
+
+SessionManager.prototype.names = function() {
+  return Object.keys(this.rooms);
+};
+
+SessionManager.prototype.roomOf = function(socket) {
+  return this.socketRooms[socket.id] || null;
+};
+
+SessionManager.prototype.join = function(name, socket) {
+  var room = this.rooms[name];
+  if (!room) return null;
+  if (this.socketRooms[socket.id] == room) return room;
+  this.leave(socket);
+  room.members[socket.id] = socket;
+  if (room.size++ == 0) {
+    this.follow(room);
+    this.present(room, true);
+  }
+  this.socketRooms[socket.id] = room;
+  socket.join(room.channel);
+  socket.join(room.formatChannel(socket));
+  if (socket.wireFormat == AnnotationCodec.FORMAT) {
+    room.binary++;
+    socket.emit('Wire', {"offset" : 0, "table" : room.encoder.table});
+  }
+  return room;
+};
+
+SessionManager.prototype.leave = function(socket) {
+  var room = this.socketRooms[socket.id];
+  if (!room) return;
+  delete room.members[socket.id];
+  if (--room.size == 0) {
+    this.unfollow(room);
+    this.present(room, false);
+  }
+  if (socket.wireFormat == AnnotationCodec.FORMAT) room.binary--;
+  delete this.socketRooms[socket.id];
+  socket.leave(room.channel);
+  socket.leave(room.formatChannel(socket));
+  if (room.size == 0) {
+    this.emit('empty', room);
+    this.closeIfIdle(room);
+  }
+};
+
+// tell the other workers whether this one has members of the room
+SessionManager.prototype.present = function(room, present) {
+  if (room.closing) {
+    clearTimeout(room.closing);
+    room.closing = null;
+  }
+  if (!this.broker) return;
+  var key = 'members:' + this.id + ':' + room.name;
+  if (present) this.broker.set(key, true);
+  else this.broker.remove(key);
+};
+
+// close the room in closeAfter ms unless somebody, in any worker, joins it by then
+SessionManager.prototype.closeIfIdle = function(room) {
+  if (this.rooms[room.name] != room) return;
+  if (room.closing) clearTimeout(room.closing);
+  var self = this;
+  room.closing = setTimeout(function() {
+    room.closing = null;
+    if (room.size || self.rooms[room.name] != room) return;
+    if (!self.broker) return self.close(room);
+    self.broker.keys('members:', function(err, keys) {
+      if (err || room.size || self.rooms[room.name] != room) return;
+      for (var i = 0; i < keys.length; i++) {
+        if (memberKey(keys[i]).name == room.name) return;
+      }
+      self.close(room);
+    });
+  }, this.closeAfter);
+  if (room.closing.unref) room.closing.unref();
+};
+
+// forget a session here and in the other workers
+SessionManager.prototype.close = function(room) {
+  this.remove(room);
+  if (!this.broker) return;
+  this.broker.remove('session:' + room.name);
+  this.broker.publish('sessions', {name: room.name, closed: true});
+};
+
+// forget a session in this process, sending its members here out of it
+SessionManager.prototype.remove = function(room) {
+  if (this.rooms[room.name] != room) return;
+  delete this.rooms[room.name];
+  if (room.closing) clearTimeout(room.closing);
+  room.closing = null;
+  for (var id in room.members) this.leave(room.members[id]);
+};
+
+// is the collection the annotations of a session with members here?
+SessionManager.prototype.following = function(collection) {
+  for (var name in this.rooms) {
+    if (this.rooms[name].size && this.rooms[name].collection == collection) return true;
+  }
+  return false;
+};
+
+// drop the ABC of sessions whose score was replaced by an upload
+SessionManager.prototype.fileChanged = function(file) {
+  for (var name in this.rooms) {
+    var room = this.rooms[name];
+    if (room.file != file) continue;
+    room.abc = null;
+    room.generation++;
+  }
+};
+
+// receive the broadcasts other workers make to a session
+SessionManager.prototype.follow = function(room) {
+  if (!this.broker) return;
+  var self = this;
+  room.relay = function(msg) {
+    if (msg.annotation) self.deliverAnnotation(room, msg.event, msg.data);
+    else self.io.to(room.channel).emit(msg.event, msg.data);
+  };
+  this.broker.subscribe(room.channel, room.relay);
+};
+
+SessionManager.prototype.unfollow = function(room) {
+  if (!this.broker || !room.relay) return;
+  this.broker.unsubscribe(room.channel, room.relay);
+  room.relay = null;
+};
+
+SessionManager.prototype.joinLobby = function(socket) {
+  socket.join(LOBBY);
+};
+
+// send to the whole lobby except the sender
+SessionManager.prototype.announce = function(socket, event, data) {
+  socket.broadcast.to(LOBBY).emit(event, data);
+  if (this.broker) this.broker.publish(LOBBY, {event: event, data: data});
+};
+
+SessionManager.prototype.broadcastAnnotation = function(room, event, data, except) {
+  this.deliverAnnotation(room, event, data, except);
+  if (this.broker) this.broker.publish(room.channel, {event: event, data: data, annotation: true});
+};
+
+// Send an annotation event to this worker's members of the room. JSON
+// members get the object as it is; the others get it packed, encoded once
+// for all of them.
+SessionManager.prototype.deliverAnnotation = function(room, event, data, except) {
+  var started = process.hrtime(), kind = label(event);
+  var json = room.channel + ':json', bin = room.channel + ':bin';
+  if (except) except.broadcast.to(json).emit(event, data);
+  else this.io.to(json).emit(event, data);
+  if (room.binary == 0 || (except && room.binary == 1 && except.wireFormat == AnnotationCodec.FORMAT)) {
+    return fanoutTime.observe({event: kind}, since(started));
+  }
+  var packed = room.encoder.encode(data);
+  if (packed.added.length) {    // everyone, the sender included, needs the new strings
+    var offset = room.encoder.table.length - packed.added.length;
+    this.io.to(bin).emit('Wire', {"offset" : offset, "table" : packed.added});
+  }
+  var buffer = Buffer.from(packed.bytes.buffer);
+  if (except) except.broadcast.to(bin).emit('Packed', buffer);
+  else this.io.to(bin).emit('Packed', buffer);
+  fanoutTime.observe({event: kind}, since(started));
+  fanoutSize.observe({event: kind}, buffer.length);
+};
+
+// pick the wire format for a socket from the ones its client can read
+SessionManager.prototype.negotiate = function(socket, formats) {
+  var room = this.roomOf(socket);
+  if (room) this.leave(socket);
+  socket.wireFormat = formats && formats.indexOf(AnnotationCodec.FORMAT) != -1 ? AnnotationCodec.FORMAT : 'json';
+  socket.emit('Wire', {"format" : socket.wireFormat});
+  if (room) this.join(room.name, socket);
+};
+
+exports.SessionManager = SessionManager;
@@ -14,8 +14,9 @@ See the GNU General Public License for more details. <http://www.gnu.org/license
 
 try:    import xml.etree.cElementTree as E
 except: import xml.etree.ElementTree as E
-import os, sys, types, re
+import os, sys, types, re, json, struct
 from fractions import Fraction
+from StringIO import StringIO
 
 VERSION = '50'
 
@@ -81,7 +82,6 @@ class Note:
         s.dur = dur     # duration of a note in XML divisions
         s.fact = None   # time modification for tuplet notes (num, div)
         s.tup = ['']    # start(s) and/or stop(s) of tuplet
-        s.tupabc = ''   # abc tuplet string to issue before note
         s.beam = 0      # 1 = beamed
         s.grace = 0     # 1 = grace note
         s.before = ''   # extra abc string that goes before the note/chord
@@ -89,6 +89,45 @@ class Note:
         s.ns = n and [n] or []  # notes in the chord
         s.lyrs = {}     # {number -> syllabe}
 
+class XmlNote:   # the fields of a musicXML note tag that do not depend on the context
+    def __init__ (s, n):
+        s.v = int (n.findtext ('voice', '1'))
+        s.chord = n.find ('chord') != None
+        s.step = n.findtext ('pitch/step')
+        s.oct = n.findtext ('pitch/octave')
+        s.rest = n.find ('rest') != None
+        s.fact = None   # time modification (num, div)
+        numer = n.findtext ('time-modification/actual-notes')
+        if numer: s.fact = (int (numer), int (n.findtext ('time-modification/normal-notes')))
+        s.tup = [x.get ('type') for x in n.findall ('notations/tuplet')]
+        s.dur = n.findtext ('duration')
+        grc = n.find ('grace')
+        s.grace = grc != None
+        s.slash = s.grace and grc.get ('slash') == 'yes'    # acciaccatura
+        s.noprint = n.get ('print-object') == 'no'
+        s.acc = n.findtext ('accidental')    # the notated accidental
+        s.alt = n.findtext ('pitch/alter')   # pitch alteration (midi)
+        ties = [e.get ('type') for e in n.findall ('tie')]
+        s.tiestart, s.tiestop = 'start' in ties, 'stop' in ties
+        s.orn, s.wavy = '', None   # ornaments before the note, type of the wavy line
+        nttn = n.find ('notations')
+        if nttn != None: s.orn, s.wavy = doNotations (nttn)
+        s.beam = sum ([1 for b in n.findall('beam') if b.text in ['continue', 'end']])
+        s.lyrs = {}     # {number -> syllabe}
+        for e in n.findall ('lyric'): s.lyrs [int (e.get ('number', '1'))] = doSyllable (e)
+        s.slurs = [(x.get ('type'), x.get ('number')) for x in n.findall ('notations/slur')]
+
+def midiPitch (step, oct, alt):     # xml pitch -> midi key number
+    return 12 * (oct + 1) + {'C':0,'D':2,'E':4,'F':5,'G':7,'A':9,'B':11}[step] + int (float (alt or 0))
+
+def melodyGrams (pitches, n=3):     # -> {interval n-gram -> count}, e.g. '+2 +2 -4'
+    ivs = [max (-24, min (24, b - a)) for a, b in zip (pitches, pitches [1:])]
+    grams = {}
+    for i in range (len (ivs) - n + 1):
+        g = ' '.join (['%+d' % x for x in ivs [i:i+n]])
+        grams [g] = grams.get (g, 0) + 1
+    return grams
+
 class Elem:
     def __init__ (s, string):
         s.tijd = 0      # the time in XML division units
@@ -110,7 +149,7 @@ class Counter:
                 info ( 'part %d, skipped empty voice %d' % (ip, iv))
 
 class Music:
-    def __init__(s, bpl, nvlt):
+    def __init__(s, bpl, nvlt, fit=0, vsel=None):
         s.tijd = 0              # the current time
         s.maxtime = 0           # maximum time in a measure
         s.gMaten = []           # [voices,.. for all measures in a part]
@@ -122,6 +161,8 @@ class Music:
         s.bpl = bpl             # the number of bars per line when writing abc
         s.repbra = 0            # true if volta is used somewhere
         s.nvlt = nvlt           # no volta on higher voice numbers
+        s.fit = fit             # true -> even line lengths instead of greedy filling
+        s.vsel = vsel           # xml voice numbers to output, None -> all
 
     def initVoices (s, newPart=0):
         s.vtimes, s.voices, s.lyrics = {}, {}, {}
@@ -199,7 +240,7 @@ class Music:
             if m.attr:                  # insert signatures at front of buffer
                 s.insertElem (v, '%s' % m.attr)
             s.appendElem (v, ' %s' % m.rline)   # insert current barline record at time maxtime
-            s.voices[v] = sortMeasure (s.voices[v], m)  # make all times consistent
+            s.voices[v] = finishMeasure (s.voices[v], m)    # make all times consistent, broken rhythms
             lyrs = s.lyrics[v]          # [{number: sylabe}, .. for all notes]
             lyrdict = {}                # {number: (abc_lyric_string, melis)} for this voice
             nums = [num for d in lyrs for num in d.keys ()] # the lyrics numbers in this measure
@@ -209,7 +250,6 @@ class Music:
                 melis = s.getLastMelis (v, i)  # get melisma from last measure
                 lyrdict [i] = abcLyr (xs, melis)
             s.lyrics[v] = lyrdict       # {number: (abc_lyric_string, melis)} for this measure
-            mkBroken (s.voices[v])
         s.gMaten.append (s.voices)
         s.gLyrics.append (s.lyrics)
         s.tijd = s.maxtime = 0
@@ -221,6 +261,7 @@ class Music:
         for iv in s.vnums:
             if s.cnt.getv ('note', iv) == 0:    # no real notes counted in this voice
                 continue            # skip empty voices
+            if s.vsel and iv not in s.vsel: continue    # voice not selected
             if abcOut.denL: unitL = abcOut.denL # take the unit length from the -d option
             else:           unitL = compUnitLength (iv, s.gMaten, divs) # compute the best unit length for this voice
             abcOut.cmpL.append (unitL)  # remember for header output
@@ -244,21 +285,20 @@ class Music:
                 if s.nvlt == 2 and iv > lvc:     abcOut.add ('I:repbra 0')  # only volta on first voice of each part
             if s.bpl > 0: maxll = s.bpl # command line option: max line length in chars
             else:         maxll = 100   # the default
-            bn = 0                      # count bars
-            while vn:                   # while still measures available
-                ib = 1
-                chunk = vn [0]
-                while ib < len (vn) and len (chunk) + len (vn [ib]) < maxll:
-                    chunk += vn [ib]
-                    ib += 1
-                bn += ib
-                abcOut.add (chunk + ' %%%d' % bn)   # line with barnumer
-                del vn[:ib]         # chop ib bars
-                lyrlines = vl.items ()
-                lyrlines.sort ()    # order the numbered lyric lines for output
+            lyrlines = vl.items ()
+            lyrlines.sort ()            # order the numbered lyric lines for output
+            if s.fit:                   # widest of music and lyrics, break where the score breaks
+                widths = [max ([len (x)] + [len (lyrs [im]) + 1 for n, lyrs in lyrlines]) for im, x in enumerate (vn)]
+                forced = [x.endswith ('$') for x in vn]
+                ends = fitBreaks (widths, maxll, forced)
+            else:
+                ends = greedyBreaks ([len (x) for x in vn], maxll)
+            ib = 0
+            for bn in ends:             # bn = number of bars up to the end of this line
+                abcOut.add (''.join (vn [ib:bn]) + ' %%%d' % bn)   # line with barnumer
                 for n, lyrs in lyrlines:
-                    abcOut.add ('w: ' + '|'.join (lyrs[:ib]) + '|')
-                    del lyrs[:ib]
+                    abcOut.add ('w: ' + '|'.join (lyrs [ib:bn]) + '|')
+                ib = bn
             vvmap [iv] = s.vceCnt   # xml voice number -> abc voice number
             s.vceCnt += 1           # count voices over all parts
         s.gMaten = []               # reset the follwing instance vars for each part
@@ -266,6 +306,120 @@ class Music:
         s.cnt.prcnt (ip+1)          # print summary of skipped items in this part
         return vvmap
 
+def greedyBreaks (widths, maxll):   # -> end of each line, lines filled up to maxll chars
+    ends, start, ll = [], 0, 0
+    for i, w in enumerate (widths):
+        if i > start and ll + w >= maxll:   # the first measure of a line always fits
+            ends.append (i)
+            start, ll = i, 0
+        ll += w
+    if widths: ends.append (len (widths))
+    return ends
+
+def fitBreaks (widths, maxll, forced):  # -> end of each line, minimal sum of squared free space
+    n = len (widths)                    # forced [i]: a line has to end after measure i
+    cost, prev = [0] + n * [None], (n + 1) * [0]
+    for j in range (1, n + 1):          # best layout of the first j measures
+        ll, i = 0, j
+        while i > 0:                    # try the line i-1 .. j-1
+            i -= 1
+            if i < j - 1 and forced [i]: break  # would hide a forced break
+            ll += widths [i]
+            if i < j - 1 and ll >= maxll: break # too long, and longer to the left
+            if j == n or forced [j-1]: c = cost [i]     # no penalty on the last line of a system
+            else:                      c = cost [i] + (maxll - ll) ** 2
+            if cost [j] == None or c < cost [j]: cost [j], prev [j] = c, i
+    ends, j = [], n
+    while j > 0:
+        ends.append (j)
+        j = prev [j]
+    ends.reverse ()
+    return ends
+
+def varlen (n):     # midi variable length quantity
+    bs = [n & 0x7f]
+    n >>= 7
+    while n:
+        bs.insert (0, (n & 0x7f) | 0x80)
+        n >>= 7
+    return ''.join (map (chr, bs))
+
+def midiTrack (events):     # [(tick, order, bytes)] -> MTrk chunk
+    events.sort ()
+    data, last = [], 0
+    for tick, order, ev in events:
+        data.append (varlen (tick - last) + ev)
+        last = tick
+    data.append ('\x00\xff\x2f\x00')   # end of track
+    body = ''.join (data)
+    return 'MTrk' + struct.pack ('>I', len (body)) + body
+
+class MidiOut:  # the notes and tempi of the parsed measures, for a Standard MIDI File (--midi)
+    tpq = 480           # ticks per quarter note
+    def __init__ (s):
+        s.tempos = []   # [(tick, microseconds per quarter)]
+        s.tracks = []   # [(abc voice number, part name, [channel, program, volume, pan], notes)]
+        s.newPart ()
+
+    def newPart (s):
+        s.offset = 0    # tick at the start of the current measure
+        s.trans = 0     # chromatic transposition of a transposing instrument
+        s.notes = {}    # xml voice number -> [[on, off, midi pitch]]
+        s.ties = {}     # (xml voice, midi pitch) -> note with an open tie
+        s.onset = 0     # tick of the last note that was not a chord note
+
+    def ticks (s, t, divs):     # time in the measure (xml divisions) -> ticks from the start
+        return s.offset + t * s.tpq // max (divs, 1)
+
+    def note (s, t, divs, xn, pitch, v):  # t = time of the note, or of the note after the chord
+        if xn.chord: on = s.onset
+        else: on = s.onset = s.ticks (t, divs)
+        off = on + int (xn.dur or 0) * s.tpq // max (divs, 1)
+        pitch += s.trans
+        nt = None
+        if xn.tiestop: nt = s.ties.pop ((v, pitch), None)
+        if nt: nt [1] = off     # a tied note only lengthens the note it continues
+        else:
+            nt = [on, off, pitch]
+            s.notes.setdefault (v, []).append (nt)
+        if xn.tiestart: s.ties [(v, pitch)] = nt
+
+    def tempo (s, t, divs, bpm):
+        s.tempos.append ((s.ticks (t, divs), int (60000000 / bpm)))
+
+    def endMeasure (s, dur, divs):
+        s.offset = s.ticks (dur, divs)
+
+    def endPart (s, vvmap, midimap, name):  # vvmap: xml voice number -> abc voice number
+        for v, vabc in vvmap.items ():
+            s.tracks.append ((vabc, name, midimap [vabc-1], s.notes.get (v, [])))
+        s.newPart ()
+
+    def write (s, fnm, mtr):
+        tempos = sorted (set (s.tempos))   # every part may repeat the tempo markings
+        if not tempos or tempos [0][0] > 0: tempos.insert (0, (0, 500000))  # 120 bpm until the first marking
+        tempo = [(t, -1, '\xff\x51\x03' + struct.pack ('>I', mpq) [1:]) for t, mpq in tempos]
+        m = re.match (r'^(\d+)/(\d+)$', mtr)
+        if m and int (m.group (2)) in [2**n for n in range (7)]:
+            dd = [2**n for n in range (7)].index (int (m.group (2)))
+            tempo.append ((0, -2, '\xff\x58\x04' + struct.pack ('>BBBB', int (m.group (1)) & 0x7f, dd, 24, 8)))
+        chunks = [midiTrack (tempo)]
+        for vabc, name, (ch, prg, vol, pan), notes in sorted (s.tracks):
+            ch = ((ch > 0 and ch or vabc) - 1) % 16
+            if type (name) == types.UnicodeType: name = name.encode ('utf-8')
+            evs = [(0, -3, '\xff\x03' + varlen (len (name)) + name)]
+            if prg > 0:  evs.append ((0, -2, struct.pack ('>BB', 0xc0 | ch, (prg - 1) & 0x7f)))
+            if vol >= 0: evs.append ((0, -1, struct.pack ('>BBB', 0xb0 | ch, 7, min (127, int (vol)))))
+            if pan >= 0: evs.append ((0, -1, struct.pack ('>BBB', 0xb0 | ch, 10, min (127, int (pan)))))
+            for on, off, pitch in notes:
+                if off <= on or not 0 <= pitch < 128: continue
+                evs.append ((on, 1, struct.pack ('>BBB', 0x90 | ch, pitch, 80)))
+                evs.append ((off, 0, struct.pack ('>BBB', 0x80 | ch, pitch, 0)))  # before notes at the same tick
+            chunks.append (midiTrack (evs))
+        f = open (fnm, 'wb')
+        f.write ('MThd' + struct.pack ('>IHHH', 6, 1, len (chunks), s.tpq) + ''.join (chunks))
+        f.close ()
+
 class ABCoutput:
     def __init__ (s, fnm, pad, X, denL, volpan):
         s.fnm = fnm
@@ -352,8 +506,12 @@ def simplify (a, b):    # divide a and b by their greatest common divisor
     while b: a, b = b, a % b
     return x / a, y / a
 
+durCache = {}   # (dur, fact, divs, uL) -> abc duration string
+
 def abcdur (nx, divs, uL):      # convert an musicXML duration d to abc units with L:1/uL
     if nx.dur == 0: return ''   # when called for elements without duration
+    key = nx.dur, nx.fact, divs, uL
+    if key in durCache: return durCache [key]   # a score uses only a handful of durations
     num, den = simplify (uL * nx.dur, divs * 4) # L=1/8 -> uL = 8 units
     if nx.fact:                 # apply tuplet time modification
         numfac, denfac = nx.fact
@@ -367,6 +525,7 @@ def abcdur (nx, divs, uL):      # convert an musicXML duration d to abc units wi
         else:          dabc = '/%d' % den
     elif den == 1:     dabc = '%d' % num
     else:              dabc = '%d/%d' % (num, den)
+    durCache [key] = dabc
     return dabc
 
 def setKey (fifths, mode):
@@ -380,98 +539,99 @@ def setKey (fifths, mode):
     else:           msralts = dict (zip (accs[fifths:], -fifths * [-1]))
     return key, msralts
 
-def insTup (ix, notes, fact):   # read one nested tuplet
-    tupcnt, halted = 0, 0
-    nx = notes [ix]
+def openTup (nx, ix, fact, tups):     # start a (nested) tuplet on note nx, its abc string is at vs [ix]
     if 'start' in nx.tup:
-        nx.tup.remove ('start') # do recursive calls when starts remain
-    tix = ix                    # index of first tuplet note
-    fn, fd = fact               # xml time-mod of the higher level
+        nx.tup.remove ('start') # nested tuplets start when starts remain
+    fn, fd = fact               # abc time-mod of the higher level
     fnum, fden = nx.fact        # xml time-mod of the current level
-    tupfact = fnum/fn, fden/fd  # abc time mod of this level
-    while ix < len (notes):
-        nx = notes [ix]
-        if isinstance (nx, Elem) or nx.grace:
-            ix += 1             # skip all non tuplet elements
-            continue
+    tups.append ([ix, (fnum/fn, fden/fd), 0, None]) # [vs index, abc time-mod, note count, nested start note]
+
+def closeTup (tup, vs):         # put abc tuplet notation before the first note, before the nested ones
+    ix, (num, den), cnt, _ = tup
+    if (num, den, cnt) == (3, 2, 3): vs [ix] = '(3' + vs [ix]
+    else:                           vs [ix] = '(%d:%d:%d' % (num, den, cnt) + vs [ix]
+
+def tupNote (nx, ix, tups, vs): # note nx (abc string at vs [ix]) inside the open tuplets
+    while tups:
+        tup = tups [-1]
         if 'start' in nx.tup:   # more nested tuplets to start
-            ix, tupcntR = insTup (ix, notes, tupfact)   # ix is on the stop note!
-            tupcnt += tupcntR
-        elif nx.fact:
-            tupcnt += 1         # count tuplet elements
+            tup [3] = nx
+            openTup (nx, ix, tup [1], tups)
+            continue            # the nested tuplet reads this note first
+        if nx.fact: tup [2] += 1    # count tuplet elements
         if 'stop' in nx.tup:
             nx.tup.remove ('stop')
-            halted = 1
-            break
-        if not nx.fact:         # stop on first non tuplet note
-            ix = lastix         # back to last tuplet note
-            halted = 1
-            break
-        lastix = ix
-        ix += 1
-    # put abc tuplet notation before the recursive ones
-    tup = (tupfact[0], tupfact[1], tupcnt)
-    if tup == (3, 2, 3): tupPrefix = '(3'
-    else:                tupPrefix = '(%d:%d:%d' % tup
-    notes [tix].tupabc = tupPrefix + notes [tix].tupabc
-    return ix, tupcnt           # ix is on the last tuplet note
-
-def mkBroken (vs):      # introduce broken rhythms (vs: one voice, one measure)
-    vs = [n for n in vs if isinstance (n, Note)]
-    i = 0
-    while i < len (vs) - 1:
-        n1, n2 = vs[i], vs[i+1]     # scan all adjacent pairs
-        # skip if note in tuplet or has no duration or outside beam
-        if not n1.fact and not n2.fact and n1.dur > 0 and n2.beam:
-            if n1.dur * 3 == n2.dur:
-                n2.dur = (2 * n2.dur) / 3
-                n1.dur = n1.dur * 2
-                n1.after = '<' + n1.after
-                i += 1              # do not chain broken rhythms
-            elif n2.dur * 3 == n1.dur:
-                n1.dur = (2 * n1.dur) / 3
-                n2.dur = n2.dur * 2
-                n1.after = '>' + n1.after
-                i += 1              # do not chain broken rhythms
-        i += 1
+            after = 1           # the tuplet ends with this note
+        elif not nx.fact:
+            after = 0           # stop on first non tuplet note, it may end the enclosing ones too
+        else:
+            return
+        while 1:                # close the tuplet and the enclosing ones that stop on its first note
+            tups.pop ()
+            closeTup (tup, vs)
+            if not tups: return
+            outer = tups [-1]
+            outer [2] += tup [2]    # nested notes count in the enclosing tuplet
+            if 'stop' not in outer [3].tup: break
+            outer [3].tup.remove ('stop')
+            tup = outer
+        if after: return
+
+def mkBroken (n1, n2):  # broken rhythm between note n1 and the next note n2 -> n1 for the next pair
+    if isinstance (n2, Elem): return n1 # only notes make pairs
+    # skip if note in tuplet or has no duration or outside beam
+    if n1 and not n1.fact and not n2.fact and n1.dur > 0 and n2.beam:
+        if n1.dur * 3 == n2.dur:
+            n2.dur = (2 * n2.dur) / 3
+            n1.dur = n1.dur * 2
+            n1.after = '<' + n1.after
+            return None         # do not chain broken rhythms
+        elif n2.dur * 3 == n1.dur:
+            n1.dur = (2 * n1.dur) / 3
+            n2.dur = n2.dur * 2
+            n1.after = '>' + n1.after
+            return None         # do not chain broken rhythms
+    return n2
 
 def outVoice (measure, divs, im, ip, unitL):    # note/elem objects of one measure in one voice
-    ix = 0
-    while ix < len (measure):   # set all (nested) tuplet annotations
-        nx = measure [ix]
-        if isinstance (nx, Note) and nx.fact:
-            ix, tupcnt = insTup (ix, measure, (1, 1))   # read one tuplet, insert annotation(s)
-        ix += 1 
-    vs = []
+    vs = []                     # abc strings, with tuplet notation added when a tuplet ends
+    tups = []                   # the open (nested) tuplets, innermost last
     for nx in measure:
         if isinstance (nx, Note):
-            durstr = abcdur (nx, divs, unitL)           # xml -> abc duration string
-            chord = len (nx.ns) > 1
-            cns = [nt[:-1] for nt in nx.ns if nt.endswith ('-')]
+            if not nx.beam: vs.append (' ')
+            ns = nx.ns
+            if len (ns) > 1:    # chord
+                cns = [nt[:-1] for nt in ns if nt.endswith ('-')]
+                if len (cns) == len (ns):   # all chord notes tied: one tie for whole chord
+                    s = '%s[%s]-' % (nx.before, ''.join (cns))
+                else:
+                    s = '%s[%s]' % (nx.before, ''.join (ns))
+            else:
+                s = nx.before + ''.join (ns)
             tie = ''
-            if chord and len (cns) == len (nx.ns):      # all chord notes tied
-                nx.ns = cns     # chord notes without tie
-                tie = '-'       # one tie for whole chord
-            s = nx.tupabc + nx.before
-            if chord: s += '['
-            for nt in nx.ns: s += nt
-            if chord: s += ']' + tie
             if s.endswith ('-'): s, tie = s[:-1], '-'   # split off tie
-            s += durstr + tie   # and put it back again
-            s += nx.after
-            nospace = nx.beam
+            vs.append ('%s%s%s%s' % (s, abcdur (nx, divs, unitL), tie, nx.after))
+            if nx.fact and not tups:
+                openTup (nx, len (vs) - 1, (1, 1), tups)    # read one tuplet, insert annotation(s)
+            if tups and not nx.grace:
+                tupNote (nx, len (vs) - 1, tups, vs)
         else:
-            s = nx.str
-            nospace = 1
-        if nospace: vs.append (s)
-        else: vs.append (' ' + s)
+            vs.append (nx.str)
+    while tups:                 # tuplets still open at the end of the measure
+        tup = tups.pop ()
+        closeTup (tup, vs)
+        if tups: tups [-1][2] += tup [2]
     return (''.join (vs))
 
-def sortMeasure (voice, m):
+def finishMeasure (voice, m):   # make all times consistent and add broken rhythms in one pass
     voice.sort (key=lambda o: o.tijd)   # sort on time
     time = 0
     v = []
+    done, n1 = 0, None          # v [:done] has broken rhythms, n1 may start the next one
     for nx in voice:    # establish sequentiality
+        while done < len (v) - 1:   # only the last element can still change
+            n1 = mkBroken (n1, v [done])
+            done += 1
         if nx.tijd > time: v.append (Note (nx.tijd - time, 'x')) # fill hole
         if isinstance (nx, Elem):
             if nx.tijd < time: nx.tijd = time # shift elems without duration to where they fit
@@ -497,8 +657,11 @@ def sortMeasure (voice, m):
         v.append (nx)
         time = nx.tijd + nx.dur
     #   when a measure contains no elements and no forwards -> no incTime -> s.maxtime = 0 -> right barline
-    #   is inserted at time == 0 (in addbar) and is only element in the voice when sortMeasure is called
+    #   is inserted at time == 0 (in addbar) and is only element in the voice when finishMeasure is called
     if time == 0: info ('empty measure in part %d, measure %d, it should contain at least a rest to advance the time!' % (m.ixp+1, m.ixm+1))
+    while done < len (v):
+        n1 = mkBroken (n1, v [done])
+        done += 1
     return v
 
 def getPartlist (ps):   # correct part-list (from buggy xml-software)
@@ -524,6 +687,23 @@ def getPartlist (ps):   # correct part-list (from buggy xml-software)
         xs.append (E.Element ('part-group', number = num, type = 'stop'))
     return xs
 
+def dropEmptyGroups (xs):   # remove part-groups without parts, left over from a part selection
+    ys = []
+    for x in xs:
+        if x.tag == 'part-group' and x.get ('type') == 'stop' and ys and ys[-1].tag == 'part-group' \
+           and ys[-1].get ('type') == 'start' and ys[-1].get ('number') == x.get ('number'):
+            ys.pop ()           # start immediately followed by its stop
+        else: ys.append (x)
+    return ys
+
+def selectParts (ps, sel):  # -> ids of the score-parts in part-list ps selected by id, number (from 1) or name
+    sel = [x.strip ().lower () for x in sel]
+    ids = []
+    for i, sp in enumerate (ps.findall ('score-part')):
+        keys = [sp.get ('id', '').lower (), str (i + 1), sp.findtext ('part-name', '').strip ().lower ()]
+        if [1 for x in sel if x in keys]: ids.append (sp.get ('id'))
+    return ids
+
 def parseParts (xs, d, e):  # -> [elems on current level], rest of xs
     if not xs: return [],[]
     x = xs.pop (0)
@@ -597,6 +777,16 @@ def compUnitLength (iv, maten, divs):   # compute optimal unit length
         if vLen < minLen: uLmin, minLen = uL, vLen  # remember the smallest
     return uLmin
 
+def doNotations (nttn):    # -> ornaments that go before the note, type of the wavy line
+    orn = ''
+    for key, val in note_ornamentation_map.items  ():
+        if nttn.find (key) != None: orn += val  # just concat all ornaments
+    fingering = nttn.find ('technical/fingering')
+    if fingering != None:   # strings or plug not supported in ABC
+        orn += '!%s!' % fingering.text     # validate text?
+    wvln = nttn.find ('ornaments/wavy-line')
+    return orn, wvln != None and wvln.get ('type') or None
+
 def doSyllable (syl):
     txt = ''
     for e in syl:
@@ -632,12 +822,14 @@ def getMelisma (maat):                  # get melisma from notes in maat
 #----------------
 class Parser:
     def __init__ (s, options):
-        # unfold repeats, number of chars per line, credit filter level, volta option
-        unfold, bpl, ctf, nvlt = options.u, options.n, options.c, options.v
+        # unfold repeats, number of chars per line, credit filter level, volta option, even lines
+        unfold, bpl, ctf, nvlt, fit = options.u, options.n, options.c, options.v, options.f
+        psel, vsel = options.parts, options.voices    # selected parts and voices
         s.slurBuf = {}    # dict of open slurs keyed by slur number
         s.wedge_type = '' # remembers the type of the last open wedge (for proper closing)
         s.ingrace = 0     # marks a sequence of grace notes
-        s.msc = Music (bpl, nvlt)  # global music data abstraction
+        s.msc = Music (bpl, nvlt, fit, vsel and map (int, vsel.split (',')))  # global music data abstraction
+        s.psel = psel and psel.split (',')  # part ids, numbers or names, None -> all parts
         s.unfold = unfold # turn unfolding repeats on
         s.ctf = ctf       # credit text filter level
         s.gStfMap = []    # [[abc voice numbers] for all parts]
@@ -648,6 +840,9 @@ class Parser:
         s.curalts = {}    # abc-notenames (with voice number) with passing accidentals
         s.stfMap = {}     # xml staff number -> [xml voice number]
         s.clefMap = {}    # xml staff number -> clef
+        s.melody = None   # (part, xml voice) -> [midi pitches], for the search index (-x)
+        if options.x: s.melody = {}
+        s.midi = options.midi and MidiOut () or None  # notes and tempi for a midi file (--midi)
 
     def matchSlur (s, type2, n, v2, note2, grace, stopgrace): # match slur number n in voice v2, add abc code to before/after
         if type2 not in ['start', 'stop']: return   # slur type continue has no abc equivalent
@@ -667,25 +862,13 @@ class Parser:
         else:                               # unmatched slur, put in dict
             s.slurBuf [n] = (type2, v2, note2, grace)
     
-    def doNotations (s, note, nttn):
-        for key, val in note_ornamentation_map.items  ():
-            if nttn.find (key) != None: note.before += val  # just concat all ornaments
-        fingering = nttn.find ('technical/fingering')
-        if fingering != None:   # strings or plug not supported in ABC
-            note.before += '!%s!' % fingering.text     # validate text?
-        wvln = nttn.find ('ornaments/wavy-line')
-        if wvln != None:
-            if   wvln.get ('type') == 'start': note.before = '!trill(!' + note.before # keep left-right order!
-            elif wvln.get ('type') == 'stop': note.after += '!trill)!'
-
-    def ntAbc (s, ptc, o, note, v):  # pitch, octave -> abc notation
+    def ntAbc (s, ptc, o, xn, v):  # pitch, octave -> abc notation
         acc2alt = {'double-flat':-2,'flat-flat':-2,'flat':-1,'natural':0,'sharp':1,'sharp-sharp':2,'double-sharp':2}
         p = ptc
         if o > 4: p = ptc.lower ()
         if o > 5: p = p + (o-5) * "'"
         if o < 4: p = p + (4-o) * ","
-        acc = note.findtext ('accidental')  # should be the notated accidental
-        alt = note.findtext ('pitch/alter') # pitch alteration (midi)
+        acc, alt = xn.acc, xn.alt
         if alt == None and s.msralts.get (ptc, 0): alt = 0  # no alt but key implies alt -> natural!!
         if acc == None and alt == None: return p    # no acc, no alt
         elif acc != None:
@@ -695,58 +878,54 @@ class Parser:
             if (p, v) in s.curalts:  # the note in this voice has been altered before
                 if alt == s.curalts [(p, v)]: return p      # alteration still the same
             elif alt == s.msralts.get (ptc, 0): return p    # alteration implied by the key
-            if 'stop' in [e.get ('type') for e in note.findall ('tie')]: return p   # don't alter tied notes
+            if xn.tiestop: return p     # don't alter tied notes
             info ('accidental %d added in part %d, measure %d, voice %d note %s' % (alt, s.msr.ixp+1, s.msr.ixm+1, v+1, p))
         s.curalts [(p, v)] = alt
         p = ['__','_','=','^','^^'][alt+2] + p # and finally ... prepend the accidental
         return p
 
-    def doNote (s, n):    # parse a musicXML note tag
+    def doNote (s, xn):   # make a note from a parsed musicXML note tag (XmlNote)
         note = Note ()
-        v = int (n.findtext ('voice', '1'))
-        chord = n.find ('chord') != None
-        p = n.findtext ('pitch/step')
-        o = n.findtext ('pitch/octave')
-        r = n.find ('rest')
-        numer = n.findtext ('time-modification/actual-notes')
-        if numer:
-            denom = n.findtext ('time-modification/normal-notes')
-            note.fact = (int (numer), int (denom))
-        note.tup = [x.get ('type') for x in n.findall ('notations/tuplet')]
-        dur = n.findtext ('duration')
-        grc = n.find ('grace')
-        note.grace = grc != None
+        v = xn.v
+        p, o = xn.step, xn.oct
+        note.fact = xn.fact
+        note.tup = xn.tup[:]
+        dur = xn.dur
+        note.grace = xn.grace
         note.before, note.after = '', '' # strings with ABC stuff that goes before or after a note/chord
         if note.grace and not s.ingrace: # open a grace sequence
             s.ingrace = 1
             note.before = '{'
-            if grc.get ('slash') == 'yes': note.before += '/'   # acciaccatura
+            if xn.slash: note.before += '/'   # acciaccatura
         stopgrace = not note.grace and s.ingrace
         if stopgrace:                   # close the grace sequence
             s.ingrace = 0
             s.msc.lastnote.after += '}' # close grace on lastenote.after
-        if r == None and n.get ('print-object') == 'no': # not a rest and not visible
+        if not xn.rest and xn.noprint:  # not a rest and not visible
             s.msc.cnt.inc ('nopr', v)   # count skipped notes
             return                      # skip non printable notes
         if dur == None or note.grace: dur = 0
         note.dur = int (dur)
-        if r == None and (not p or not o):  # not a rest and no pitch
+        if not xn.rest and (not p or not o):    # not a rest and no pitch
             s.msc.cnt.inc ('nopt', v)       # count unpitched notes
             o, p = 5,'E'                    # make it an E5 ??
-        nttn = n.find ('notations')     # add ornaments
-        if nttn != None: s.doNotations (note, nttn)
-        if r != None: noot = 'z'
-        else: noot = s.ntAbc (p, int (o), n, v)
-        if 'start' in [e.get ('type') for e in n.findall ('tie')]:  # n can have stop and start tie
+        elif s.midi and not xn.rest and not note.grace:
+            s.midi.note (s.msc.tijd, s.msr.divs, xn, midiPitch (p, int (o), xn.alt), v)
+        note.before += xn.orn           # add ornaments
+        if   xn.wavy == 'start': note.before = '!trill(!' + note.before # keep left-right order!
+        elif xn.wavy == 'stop': note.after += '!trill)!'
+        if xn.rest: noot = 'z'
+        else: noot = s.ntAbc (p, int (o), xn, v)
+        if s.melody != None and xn.step and not xn.rest and not xn.chord and not note.grace and not xn.tiestop:
+            s.melody.setdefault ((s.msr.ixp, v), []).append (midiPitch (p, int (o), xn.alt))
+        if xn.tiestart:                 # n can have stop and start tie
             noot = noot + '-'
-        note.beam = sum ([1 for b in n.findall('beam') if b.text in ['continue', 'end']]) + int (note.grace)
-        for e in n.findall ('lyric'):
-            lyrnum = int (e.get ('number', '1'))
-            note.lyrs [lyrnum] = doSyllable (e)
-        if chord: s.msc.addChord (noot)
-        else:     s.msc.appendNote (v, note, noot)
-        for slur in n.findall ('notations/slur'):   # s.msc.lastnote points to the last real note/chord inserted above
-            s.matchSlur (slur.get ('type'), slur.get ('number'), v, s.msc.lastnote, note.grace, stopgrace) # match slur definitions
+        note.beam = xn.beam + int (note.grace)
+        note.lyrs = dict (xn.lyrs)
+        if xn.chord: s.msc.addChord (noot)
+        else:        s.msc.appendNote (v, note, noot)
+        for type, n in xn.slurs:        # s.msc.lastnote points to the last real note/chord inserted above
+            s.matchSlur (type, n, v, s.msc.lastnote, note.grace, stopgrace) # match slur definitions
 
     def doAttr (s, e): # parse a musicXML attribute tag
         teken = {'C1':'alto1','C2':'alto2','C3':'alto','C4':'tenor','F4':'bass','F3':'bass3','G2':'treble','TAB':'','percussion':'perc'}
@@ -769,6 +948,7 @@ class Parser:
             s.msr.mdur = (s.msr.divs * int (beats) * 4) / int (unit)    # duration of measure in xml-divisions
         toct = e.findtext ('transpose/octave-change', '')
         if toct: steps += 12 * int (toct)       # extra transposition of toct octaves
+        if s.midi and e.find ('transpose') != None: s.midi.trans = steps  # midi sounds at concert pitch
         for clef in e.findall ('clef'):         # a part can have multiple staves
             n = int (clef.get ('number', '1'))  # local staff number for this clef
             sgn = clef.findtext ('sign')
@@ -788,6 +968,7 @@ class Parser:
             if tempo:
                 if '.' in tempo: tempo = '%.2f' % float (tempo) # hope it is a number and insert in voice 1
                 else:            tempo = '%d' % int (tempo)
+                if s.midi: s.midi.tempo (s.msc.tijd, s.msr.divs, float (tempo))
                 if s.msc.tijd == 0 and s.msr.ixm == 0: abcOut.tempo = tempo   # first measure -> header
                 else: s.msr.attr += '[Q:1/4=%s]' % tempo    # otherwise -> voice
         stfnum = int (e.findtext ('staff',1))   # directions belong to a staff
@@ -880,10 +1061,11 @@ class Parser:
             s.instMid.append (midi)
         ps = e.find ('part-list')               # partlist  = [groupelem]
         xs = getPartlist (ps)                   # groupelem = partname | grouplist
+        if s.psel: xs = dropEmptyGroups (xs)
         partlist, _ = parseParts (xs, {}, [])   # grouplist = [groupelem, ..., groupdata]
         return partlist                         # groupdata = [group-symbol, group-barline, group-name, group-abbrev]
 
-    def mkTitle (s, e):
+    def titleFields (s, e):    # -> title, movement title, composers, lyricists, filtered credits
         def filterCredits (y):  # y == filter level, higher filters less
             cs = []
             for x in credits:   # skip redundant credit lines
@@ -908,6 +1090,10 @@ class Parser:
             cs = ''.join (e.text or '' for e in credit.findall('credit-words'))
             credits += [re.sub (r'\s*[\r\n]\s*', ' ', cs)]
         credits = filterCredits (s.ctf)
+        return title, mvttl, composer, lyricist, credits
+
+    def mkTitle (s, e):
+        title, mvttl, composer, lyricist, credits = s.titleFields (e)
         if title: title = 'T:%s\n' % title
         if mvttl: title += 'T:%s\n' % mvttl
         if credits: title += '\n'.join (['T:%s' % c for c in credits]) + '\n'
@@ -961,11 +1147,65 @@ class Parser:
         xs.sort ()  # put abc voices in order
         s.midiMap.extend ([midi for v, midi in xs])
 
+    def scoreInfo (s, fobj):   # header-only metadata of a score, for the catalog
+        data = fobj.read ()
+        root = None
+        for event, elem in E.iterparse (StringIO (data), ('start',)):
+            if root is None: root = elem
+            elif elem.tag == 'part': break  # the header is complete, skip all measures
+        title, mvttl, composer, lyricist, credits = s.titleFields (root)
+        s.doPartList (root)                 # midi settings of all parts -> s.instMid
+        parts = []
+        for sp, midi in zip (root.findall ('part-list/score-part'), s.instMid):
+            progs = sorted (set ([prg - 1 for ch, prg, vol, pan in midi.values () if prg > 0]))
+            parts.append ({'id': sp.get ('id'), 'name': sp.findtext ('part-name', ''),
+                           'abbreviation': sp.findtext ('part-abbreviation', ''), 'programs': progs})
+        txt = data [:2] in ('\xfe\xff', '\xff\xfe') and data.decode ('utf-16') or data
+        i = txt.find ('<part ', max (0, txt.find ('</part-list>')))    # count measures of the first part
+        j = txt.find ('</part>', i)         # without parsing them
+        nmsr = i >= 0 and j > i and len (re.findall (r'<measure[\s>]', txt [i:j])) or 0
+        return {'title': title, 'movement': mvttl, 'composer': composer, 'lyricist': lyricist,
+                'credits': credits or [], 'parts': parts, 'partCount': len (parts), 'measures': nmsr}
+
+    def searchTerms (s, e):     # -> the fields and melody of a converted score, for the search index
+        title, mvttl, composer, lyricist, credits = s.titleFields (e)
+        grams = {}
+        for pitches in s.melody.values ():  # interval n-grams of every voice
+            for g, n in melodyGrams (pitches).items (): grams [g] = grams.get (g, 0) + n
+        parts = [sp.findtext ('part-name', '') for sp in e.findall ('part-list/score-part')]
+        return {'title': title, 'movement': mvttl, 'composer': composer, 'lyricist': lyricist,
+                'parts': parts, 'key': abcOut.key, 'metre': abcOut.mtr, 'melody': grams}
+
+    def prepMeasure (s, maat):  # -> [(tag, element, parsed data)] for all tags in a measure
+        ops = []                # only notes and time shifts are parsed here, the other tags depend on
+        for e in maat.getchildren ():   # the state at the time they are met and are handled when replayed
+            if   e.tag == 'note': ops.append ((e.tag, e, XmlNote (e)))
+            elif e.tag in ('backup', 'forward'): ops.append ((e.tag, e, int (e.findtext ('duration'))))
+            else: ops.append ((e.tag, e, None))
+        return ops
+
+    def readScore (s, fobj):    # -> the score element, without the parts that are not selected
+        if not s.psel: return E.parse (fobj).getroot ()
+        root, keep, skip = None, None, 0
+        for event, elem in E.iterparse (fobj, ('start', 'end')):
+            if root is None: root = elem
+            elif elem.tag == 'part-list' and event == 'end':
+                keep = selectParts (elem, s.psel)
+                for sp in elem.findall ('score-part'):
+                    if sp.get ('id') not in keep: elem.remove (sp)
+            elif elem.tag == 'part' and keep != None:
+                if event == 'start': skip = elem.get ('id') not in keep
+                elif skip: root.remove (elem); skip = 0    # whole part read and dropped
+            elif skip and event == 'end' and elem.tag == 'measure':
+                elem.clear ()   # don't keep the measures of a part that is dropped
+        return root
+
     def parse (s, fobj):
-        e = E.parse (fobj)
-        s.mkTitle (e)
-        partlist = s.doPartList (e)
-        parts = e.findall ('part')
+        score = s.readScore (fobj)
+        s.mkTitle (score)
+        partlist = s.doPartList (score)
+        parts = score.findall ('part')
+        if not parts: info ('nothing written, no part in %s matches %s' % (abcOut.fnm, ','.join (s.psel or [])))
         for ip, p in enumerate (parts):
             maten = p.findall ('measure')
             s.locStaffMap (p)   # {voice -> staff} for this part
@@ -973,26 +1213,27 @@ class Parser:
             aantalHerhaald = 0  # keep track of number of repititions
             herhaalMaat = 0     # target measure of the repitition
             s.msr = Measure (ip)   # various measure data
+            msrOps = {}         # measure number -> prepared tags, reused when a repeat is unfolded
             while s.msr.ixm < len (maten):
                 maat = maten [s.msr.ixm]
                 herhaal, lbrk = 0, ''
                 s.msr.reset ()
                 s.curalts = {}  # passing accidentals are reset each measure
-                es = maat.getchildren ()
-                for e in es:
-                    if   e.tag == 'note':       s.doNote (e)
-                    elif e.tag == 'attributes': s.doAttr (e)
-                    elif e.tag == 'direction':  s.doDirection (e)
-                    elif e.tag == 'sound':      s.doDirection (maat) # sound element directly in measure!
-                    elif e.tag == 'harmony':    s.doHarmony (e)
-                    elif e.tag == 'barline': herhaal = s.doBarline (e)
-                    elif e.tag == 'backup':
-                        dt = int (e.findtext ('duration'))
-                        s.msc.incTime (-dt)
-                    elif e.tag == 'forward':
-                        dt = int (e.findtext ('duration'))
-                        s.msc.incTime (dt)
-                    elif e.tag == 'print':  lbrk = s.doPrint (e)
+                ops = msrOps.get (s.msr.ixm)
+                if ops == None:
+                    ops = s.prepMeasure (maat)
+                    if s.unfold: msrOps [s.msr.ixm] = ops
+                for tag, e, x in ops:
+                    if   tag == 'note':       s.doNote (x)
+                    elif tag == 'attributes': s.doAttr (e)
+                    elif tag == 'direction':  s.doDirection (e)
+                    elif tag == 'sound':      s.doDirection (maat) # sound element directly in measure!
+                    elif tag == 'harmony':    s.doHarmony (e)
+                    elif tag == 'barline': herhaal = s.doBarline (e)
+                    elif tag == 'backup':     s.msc.incTime (-x)
+                    elif tag == 'forward':    s.msc.incTime (x)
+                    elif tag == 'print':  lbrk = s.doPrint (e)
+                if s.midi: s.midi.endMeasure (s.msc.maxtime or s.msr.mdur, s.msr.divs)
                 s.msc.addBar (lbrk, s.msr)
                 if   herhaal == 1:
                     herhaalMaat = s.msr.ixm
@@ -1008,10 +1249,14 @@ class Parser:
             vvmap = s.msc.outVoices (s.msr.divs, ip)
             s.addStaffMap (vvmap)           # update global staff map
             s.addMidiMap (ip, vvmap)
-        if vvmap:
+            if s.midi:
+                name = [sp.findtext ('part-name', '') for sp in score.findall ('part-list/score-part') if sp.get ('id') == p.get ('id')]
+                s.midi.endPart (vvmap, s.midiMap, name and name [0] or '')
+        if s.msc.vceCnt > 1:    # any voice written
             abcOut.mkHeader (s.gStfMap, partlist, s.midiMap)
             abcOut.writeall ()
-        else: info ('nothing written, %s has no notes ...' % abcOut.fnm)
+        elif parts: info ('nothing written, %s has no notes ...' % abcOut.fnm)
+        if s.melody != None: return s.searchTerms (score)
 
 #----------------
 # Main Program
@@ -1020,9 +1265,15 @@ if __name__ == '__main__':
     from optparse import OptionParser
     from glob import glob
     from zipfile import ZipFile 
-    parser = OptionParser (usage='%prog [-h] [-u] [-m] [-c C] [-d D] [-n BPL] [-o DIR] <file1> [<file2> ...]', version=VERSION)
+    parser = OptionParser (usage='%prog [-h] [-u] [-m] [-i] [-f] [-p PARTS] [--voices VOICES] [-x FILE] [--midi FILE] [-c C] [-d D] [-n BPL] [-o DIR] <file1> [<file2> ...]', version=VERSION)
     parser.add_option ("-u", action="store_true", help="unfold simple repeats")
     parser.add_option ("-m", action="store_true", help="also output midi channel, volume and panning when needed")
+    parser.add_option ("-i", action="store_true", help="only read the score header and print it as one line of JSON per file")
+    parser.add_option ("-f", action="store_true", help="even out line lengths, also counting lyrics, and break lines where the score does")
+    parser.add_option ("-p", "--parts", action="store", help="only convert the parts in PARTS: ids, numbers (from 1) or names, separated by commas", metavar='PARTS')
+    parser.add_option ("--voices", action="store", help="only output the xml voice numbers in VOICES, separated by commas", metavar='VOICES')
+    parser.add_option ("-x", action="store", help="also append the search terms of every converted score to FILE, one line of JSON per file", metavar='FILE')
+    parser.add_option ("--midi", action="store", help="also write the converted score as a Standard MIDI File to FILE (one input file only)", metavar='FILE')
     parser.add_option ("-c", action="store", type="int", help="set credit text filter to C", default=0, metavar='C')
     parser.add_option ("-d", action="store", type="int", help="set L:1/D", default=0, metavar='D')
     parser.add_option ("-n", action="store", type="int", help="BPL: number of bars per line", default=0, metavar='BPL')
@@ -1030,6 +1281,7 @@ if __name__ == '__main__':
     parser.add_option ("-v", action="store", type="int", help="set volta typesetting behaviour to V", default=0, metavar='V')
     options, args = parser.parse_args ()
     if options.n < 0: parser.error ('only values >= 0')
+    if options.voices and not re.match (r'^\d+(,\d+)*$', options.voices): parser.error ('VOICES should be numbers separated by commas')
     if options.d and options.d not in [2**n for n in range (10)]:
         parser.error ('D should be on of %s' % ','.join ([str(2**n) for n in range (10)]))
     if len (args) == 0: parser.error ('no input file given')
@@ -1040,6 +1292,7 @@ if __name__ == '__main__':
     fnmext_list = []
     for i in args: fnmext_list += glob (i)
     if not fnmext_list: parser.error ('none of the input files exist')
+    if options.midi and len (fnmext_list) > 1: parser.error ('--midi needs exactly one input file')
     for X, fnmext in enumerate (fnmext_list):
         fnm, ext = os.path.splitext (fnmext)
         if ext.lower () not in ('.xml','.mxl'):
@@ -1057,8 +1310,20 @@ if __name__ == '__main__':
         else:
             fobj = open (fnmext)            # open regular xml file
 
+        if options.i:                       # catalog metadata instead of ABC
+            try:
+                meta = Parser (options).scoreInfo (fobj)
+                meta ['file'] = os.path.basename (fnmext)
+                print json.dumps (meta)
+            except Exception, err: info ('** %s occurred in %s: %s' % (type (err), fnmext, err), 0)
+            continue
+
         abcOut = ABCoutput (fnm + '.abc', pad, X, options.d, options.m)  # create global ABC output object
         psr = Parser (options)  # xml parser
         try:
-            psr.parse (fobj)    # parse file fobj and write abc to <fnm>.abc
+            terms = psr.parse (fobj)    # parse file fobj and write abc to <fnm>.abc
+            if terms != None:
+                terms ['file'] = os.path.basename (fnmext)
+                xf = open (options.x, 'a'); xf.write (json.dumps (terms) + '\n'); xf.close ()
+            if psr.midi: psr.midi.write (options.midi, abcOut.mtr)
         except Exception, err: info ('** %s occurred: %s' % (type (err), err), 0)